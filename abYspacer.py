@@ -1,9 +1,647 @@
 #!/usr/bin/python3
 
 import argparse
+import bisect
+import cProfile
+import gzip
+import hashlib
+import io
+import multiprocessing
+import json
+import os
+import random
+import socketserver
+import sqlite3
+import stat
 import sys
 import re
+import signal
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ABNUM_URL = "http://www.bioinf.org.uk/abs/abnum/abnum.cgi"
+
+RECORDED_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "abnum_recorded.json")
+DEFAULT_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "abyspacer", "numbering.sqlite")
+
+class run_metrics():
+    """
+    Per-stage timers, counters and failure categories for a numbering run. When `enabled` is False
+    `start()` returns None and every other call returns straight away, so the hooks left in the
+    hot path cost next to nothing.
+    """
+
+    latency_buckets_ms=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self, enabled=False):
+
+        self.enabled=enabled
+        self.started=time.time()
+        self.lock=threading.Lock()
+        self.counters=Counter()
+        self.failures=Counter()
+        self.timers={}
+        self.latency=[0]*(len(self.latency_buckets_ms)+1)
+        self.input_size=None
+        self.input_position=0
+
+    def __repr__(self):
+        return "Run metrics ("+("enabled" if self.enabled else "disabled")+")"
+
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, stage, start):
+        """
+        Add the time since `start` to a stage
+        :param stage: STRING, stage name such as "http" or "spacing"
+        :param start: FLOAT, value returned by `start()`
+        """
+        if start is None:
+            return
+        elapsed=time.perf_counter()-start
+        with self.lock:
+            timer=self.timers.setdefault(stage, [0, 0.0])
+            timer[0]+=1
+            timer[1]+=elapsed
+        return elapsed
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name]+=n
+
+    def failure(self, category):
+        """
+        Count a failed chain or pair
+        :param category: STRING, e.g. "incomplete_v_region", "empty_response", "http_error"
+        """
+        if self.enabled:
+            with self.lock:
+                self.failures[category]+=1
+
+    def request(self, start, size):
+        """
+        Record one HTTP request in the latency histogram
+        :param start: FLOAT, value returned by `start()` before the request was sent
+        :param size: INT, bytes received
+        """
+        elapsed=self.stop("http", start)
+        if elapsed is None:
+            return
+        with self.lock:
+            self.counters["requests"]+=1
+            self.counters["bytes_received"]+=size
+            self.latency[bisect.bisect_left(self.latency_buckets_ms, elapsed*1000)]+=1
+
+    def drain(self):
+        """
+        Hand over everything recorded so far and start again from zero, used to ship a worker
+        process's measurements back to the parent
+        :return: TUPLE, (counters, failures, timers, latency histogram)
+        """
+        with self.lock:
+            data=(self.counters, self.failures, self.timers, self.latency)
+            self.counters, self.failures, self.timers=Counter(), Counter(), {}
+            self.latency=[0]*(len(self.latency_buckets_ms)+1)
+        return data
+
+    def merge(self, data):
+        """
+        Add measurements returned by `drain()` in another process
+        """
+        counters, failures, timers, latency=data
+        with self.lock:
+            self.counters.update(counters)
+            self.failures.update(failures)
+            for stage, (calls, seconds) in timers.items():
+                timer=self.timers.setdefault(stage, [0, 0.0])
+                timer[0]+=calls
+                timer[1]+=seconds
+            self.latency=[a+b for a, b in zip(self.latency, latency)]
+
+    def progress(self, pairs):
+        """
+        Build a progress line
+        :param pairs: INT, pairs processed so far in this run
+        :return: STRING, pairs done, throughput and, when the input size is known, an ETA
+        """
+        elapsed=time.time()-self.started
+        line="%d pairs in %.0fs (%.1f pairs/sec)" % (pairs, elapsed, pairs/elapsed if elapsed>0 else 0.0)
+        if self.input_size and self.input_position:
+            fraction=min(1.0, self.input_position/float(self.input_size))
+            line+=", %.1f%% of input read, ETA %.0fs" % (100*fraction, elapsed*(1-fraction)/fraction)
+        return line
+
+    def report(self):
+        """
+        :return: DICT, everything recorded so far, ready for json.dump
+        """
+        with self.lock:
+            report={"seconds":time.time()-self.started,
+                    "counters":dict(self.counters),
+                    "failures":dict(self.failures),
+                    "stages":{stage: {"calls":calls, "seconds":seconds} for stage, (calls, seconds) in self.timers.items()},
+                    "http_latency_ms":[{"le":bucket, "count":count} for bucket, count in zip(self.latency_buckets_ms+["inf"], self.latency)]}
+            if "cache_hits" in self.counters or "cache_misses" in self.counters:
+                report["cache"]={"hits":self.counters["cache_hits"], "misses":self.counters["cache_misses"]}
+            elif cache is not None:
+                report["cache"]={"hits":cache.hits, "misses":cache.misses}
+        return report
+
+metrics=run_metrics()
+
+class numbering_cache():
+    """
+    On-disk cache of raw AbNum numbering lists, keyed by (normalised sequence, scheme).
+    Backed by SQLite in WAL mode so several processes can share one cache file. Entries are
+    evicted least-recently-used first once the cache holds more than `max_entries` numberings.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=1000000):
+
+        self.path=path
+        self.max_entries=max_entries
+        self.hits=0
+        self.misses=0
+        # evict on the first put, then after every 1% of max_entries puts, so that many short runs
+        # sharing the file cannot each add more than that before it is trimmed again
+        self._evict_every=max(1, max_entries//100)
+        self._puts=self._evict_every-1
+        self._local=threading.local()
+        self._count_lock=threading.Lock()
+        directory=os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().execute("CREATE TABLE IF NOT EXISTS numbering (key TEXT PRIMARY KEY, scheme TEXT, aaseq TEXT, lst TEXT, last_used REAL)")
+        self._connect().execute("CREATE INDEX IF NOT EXISTS numbering_last_used ON numbering (last_used)")
+
+    def __repr__(self):
+        return "Numbering cache at %s (%d hits, %d misses)" % (self.path, self.hits, self.misses)
+
+    def _connect(self):
+        # one connection per thread and per process, sqlite connections must not cross either
+        conn=getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn=sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn=conn
+            self._local.pid=os.getpid()
+        return conn
+
+    @staticmethod
+    def normalise(aaseq):
+        """
+        Normalise a sequence before it is used as a cache key
+        :param aaseq: STRING, amino acid sequence
+        :return: STRING, upper case sequence with all whitespace removed
+        """
+        return "".join(aaseq.split()).upper()
+
+    def key(self, aaseq, scheme):
+        return hashlib.sha1((scheme+":"+self.normalise(aaseq)).encode()).hexdigest()
+
+    def get(self, aaseq, scheme):
+        """
+        Look up a numbering in the cache
+        :param aaseq: STRING, amino acid sequence
+        :param scheme: STRING, numbering scheme
+        :return: LIST, the whitespace-split AbNum response, or None on a miss
+        """
+        key=self.key(aaseq, scheme)
+        try:
+            conn=self._connect()
+            row=conn.execute("SELECT lst FROM numbering WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self._count(hit=False)
+                return None
+            conn.execute("UPDATE numbering SET last_used=? WHERE key=?", (time.time(), key))
+        except sqlite3.Error as e:
+            print("Numbering cache unavailable: "+str(e))
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return row[0].split()
+
+    def drain(self):
+        """
+        Hand over the hit and miss counts and start again from zero, used to ship a worker
+        process's counts back to the parent
+        :return: TUPLE, (hits, misses)
+        """
+        with self._count_lock:
+            counts=(self.hits, self.misses)
+            self.hits, self.misses=0, 0
+        return counts
+
+    def _count(self, hit):
+        # lookups come from the number_many thread pool
+        with self._count_lock:
+            if hit:
+                self.hits+=1
+            else:
+                self.misses+=1
+
+    def put(self, aaseq, scheme, lst):
+        """
+        Store a numbering in the cache, evicting the least recently used entries when full
+        :param aaseq: STRING, amino acid sequence
+        :param scheme: STRING, numbering scheme
+        :param lst: LIST, the whitespace-split AbNum response
+        """
+        try:
+            conn=self._connect()
+            conn.execute("INSERT OR REPLACE INTO numbering VALUES (?, ?, ?, ?, ?)", (self.key(aaseq, scheme), scheme, self.normalise(aaseq), " ".join(lst), time.time()))
+            with self._count_lock:
+                self._puts+=1
+                due=self._puts>=self._evict_every
+                if due:
+                    self._puts=0
+            if due:
+                self.evict()
+        except sqlite3.Error as e:
+            print("Numbering cache unavailable: "+str(e))
+
+    def evict(self):
+        conn=self._connect()
+        conn.execute("DELETE FROM numbering WHERE key IN (SELECT key FROM numbering ORDER BY last_used LIMIT max(0, (SELECT COUNT(*) FROM numbering) - ?))", (self.max_entries,))
+
+cache=None
+
+def open_cache(path, max_entries):
+    """
+    Open the numbering cache, or carry on without one if it cannot be used
+    :return: numbering_cache, or None if the file cannot be created or is not a cache
+    """
+    try:
+        return numbering_cache(path, max_entries)
+    except (OSError, sqlite3.Error) as e:
+        print("Numbering cache unavailable: "+str(e))
+        return None
+
+class abnum_client():
+    """
+    Pooled HTTP client for the AbNum CGI. Connections are kept alive and shared between threads,
+    every request has a timeout, failed requests are retried with exponential backoff and
+    requests are spaced out so that no more than `rate` per second reach the server.
+    """
+
+    def __init__(self, url=ABNUM_URL, pool_size=10, timeout=30, retries=4, backoff=1.0, rate=10.0):
+
+        self.url=url
+        self.timeout=timeout
+        self.retries=retries
+        self.backoff=backoff
+        self.rate=rate
+        self.session=requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._lock=threading.Lock()
+        self._next_slot=0.0
+
+    def __repr__(self):
+        return "AbNum client for %s" % self.url
+
+    def _wait_for_slot(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now=time.monotonic()
+            slot=max(now, self._next_slot)
+            self._next_slot=slot+1.0/self.rate
+        if slot>now:
+            time.sleep(slot-now)
+
+    def get(self, params):
+        """
+        Send one query to AbNum
+        :param params: DICT, query parameters for the CGI
+        :return: STRING, the body of the response
+        :raises: `requests.RequestException` once all retries have failed
+        """
+        for attempt in range(self.retries+1):
+            self._wait_for_slot()
+            start=metrics.start()
+            try:
+                page=self.session.get(self.url, params=params, timeout=self.timeout)
+                metrics.request(start, len(page.content))
+                if page.status_code==429 or page.status_code>=500:
+                    page.raise_for_status()
+                return page.text
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                metrics.count("http_retries" if attempt<self.retries else "http_errors")
+                if attempt==self.retries:
+                    raise
+                time.sleep(self.backoff*2**attempt*(1+random.random()))
+
+client=abnum_client()
+
+SCHEME_FLAGS = {"kabat":"-k", "chothia":"-c", "martin":"-m"}
+
+class abnum_backend():
+    """
+    Numbering backend that asks the AbNum CGI through the module-level `client`.
+    """
+
+    name="abnum"
+    cache_tag=""
+
+    def __repr__(self):
+        return "AbNum web numbering"
+
+    def number(self, aaseq, scheme):
+        """
+        Number one sequence
+        :param aaseq: STRING, amino acid sequence
+        :param scheme: STRING, kabat, chothia or martin
+        :return: LIST, alternating position labels and residues, e.g. ["H1", "Q", "H2", "V", ...]
+        """
+        return client.get({"plain":1, "scheme":SCHEME_FLAGS[scheme], "aaseq":aaseq}).split()
+
+BLOSUM62_ORDER = "ARNDCQEGHILKMFPSTWYV"
+BLOSUM62_ROWS = """
+ 4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0
+-1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3
+-2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3
+-2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3
+ 0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1
+-1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2
+-1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2
+ 0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3
+-2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3
+-1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3
+-1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1
+-1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2
+-1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1
+-2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1
+-1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2
+ 1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2
+ 0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0
+-3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3
+-2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1
+ 0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4
+"""
+BLOSUM62 = {}
+for _a, _row in zip(BLOSUM62_ORDER, BLOSUM62_ROWS.split("\n")[1:]):
+    for _b, _score in zip(BLOSUM62_ORDER, _row.split()):
+        BLOSUM62[_a, _b]=int(_score)
+
+def _labels(chain, start, end, insertions=()):
+    """
+    Build a run of position labels, e.g. _labels("H", 80, 84, ["82A"]) -> H80 H81 H82 H82A H83 H84
+    """
+    lst=[]
+    for number in range(start, end+1):
+        lst.append(chain+str(number))
+        lst.extend([chain+label for label in insertions if re.match(str(number)+"[A-Z]$", label)])
+    return lst
+
+# Consensus V-domain templates. Each region is (name, consensus, framework labels by scheme);
+# CDRs have no fixed labels, they are numbered from their length by LOCAL_CDR_RULES.
+LOCAL_TEMPLATES = {
+    "H": [("FR1", "EVQLVESGGGLVQPGGSLRLSCAASGFTFS", {"": _labels("H", 1, 30)}),
+          ("CDR1", "SYAMS", None),
+          ("FR2", "WVRQAPGKGLEWVS", {"": _labels("H", 36, 49)}),
+          ("CDR2", "AISGSGSTYYADSVKG", None),
+          ("FR3", "RFTISRDNSKNTLYLQMNSLRAEDTAVYYCAK", {"": _labels("H", 66, 94, ["82A", "82B", "82C"]), "martin": _labels("H", 66, 94, ["72A", "72B", "72C"])}),
+          ("CDR3", "DRGYFFDY", None),
+          ("FR4", "WGQGTLVTVSS", {"": _labels("H", 103, 113)})],
+    "K": [("FR1", "DIQMTQSPSSLSASVGDRVTITC", {"": _labels("L", 1, 23)}),
+          ("CDR1", "RASQSISSYLN", None),
+          ("FR2", "WYQQKPGKAPKLLIY", {"": _labels("L", 35, 49)}),
+          ("CDR2", "AASSLQS", None),
+          ("FR3", "GVPSRFSGSGSGTDFTLTISSLQPEDFATYYC", {"": _labels("L", 57, 88)}),
+          ("CDR3", "QQSYSTPLT", None),
+          ("FR4", "FGQGTKVEIKR", {"": _labels("L", 98, 108)})],
+    "L": [("FR1", "QSVLTQPPSVSGAPGQRVTISC", {"": _labels("L", 1, 9)+_labels("L", 11, 23)}),
+          ("CDR1", "TGSSSNIGAGYDVH", None),
+          ("FR2", "WYQQLPGTAPKLLIY", {"": _labels("L", 35, 49)}),
+          ("CDR2", "GNSNRPS", None),
+          ("FR3", "GVPDRFSGSKSGTSASLAITGLQAEDEADYYC", {"": _labels("L", 57, 88)}),
+          ("CDR3", "QSYDSSLSGSV", None),
+          ("FR4", "FGGGTKLTVLG", {"": _labels("L", 98, 106, ["106A"])+["L107"], "martin": _labels("L", 98, 107, ["107A"])})],
+}
+
+# (core positions, position insertions follow, order positions are dropped in when the CDR is short)
+LOCAL_CDR_RULES = {
+    ("H", "CDR1", ""): (range(31, 36), 35, [35, 34, 33]),
+    ("H", "CDR1", "chothia"): (range(31, 36), 31, [31, 32, 33]),
+    ("H", "CDR1", "martin"): (range(31, 36), 31, [31, 32, 33]),
+    ("H", "CDR2", ""): (range(50, 66), 52, [52, 53, 54, 55]),
+    ("H", "CDR3", ""): (range(95, 103), 100, [100, 99, 98, 97, 96, 101]),
+    ("L", "CDR1", ""): (range(24, 35), 27, [28, 29, 30, 31]),
+    ("L", "CDR1", "chothia"): (range(24, 35), 30, [31, 32, 33, 34]),
+    ("L", "CDR1", "martin"): (range(24, 35), 30, [31, 32, 33, 34]),
+    ("L", "CDR2", ""): (range(50, 57), 52, [52, 53, 54]),
+    ("L", "CDR3", ""): (range(89, 98), 95, [95, 94, 93, 92]),
+}
+
+class local_backend():
+    """
+    Offline numbering backend. The sequence is aligned against heavy, kappa and lambda consensus
+    templates (semi-global affine alignment with BLOSUM62, gaps being much cheaper inside CDRs);
+    framework residues take the label of the template position they align to and each CDR is
+    numbered from its length, placing insertions where the scheme puts them (H35A/H31A, H52A,
+    H100A, L27A/L30A, L95A...). The result has the same format as an AbNum plain response.
+    """
+
+    name="local"
+    cache_tag="local:"
+    fr_gap_open=10
+    fr_gap_extend=2
+    cdr_gap_open=2
+    cdr_gap_extend=1
+    min_score=150
+
+    def __init__(self):
+
+        self.templates={}
+        for chain_type, regions in LOCAL_TEMPLATES.items():
+            residues, region_index, gap_open, gap_extend=[], [], [], []
+            for index, (region, consensus, fr_labels) in enumerate(regions):
+                residues.extend(consensus)
+                region_index.extend([index]*len(consensus))
+                gap_open.extend([self.fr_gap_open if fr_labels else self.cdr_gap_open]*len(consensus))
+                gap_extend.extend([self.fr_gap_extend if fr_labels else self.cdr_gap_extend]*len(consensus))
+            self.templates[chain_type]=(residues, region_index, gap_open, gap_extend)
+
+    def __repr__(self):
+        return "Local template numbering"
+
+    def align(self, aaseq, chain_type):
+        """
+        Align a sequence to one template, with free end gaps on both sequences
+        :param aaseq: STRING, amino acid sequence
+        :param chain_type: STRING, "H", "K" or "L"
+        :return: LIST, [score, for each query residue its template index, ("ins", j) when inserted after template position j, or None when unaligned]
+        """
+        residues, region_index, gap_open, gap_extend=self.templates[chain_type]
+        n, m=len(aaseq), len(residues)
+        NEG=-10**9
+        # insertions after template position j are cheap if either neighbour is in a CDR
+        ins_open=[min(gap_open[max(j-1, 0)], gap_open[min(j, m-1)]) for j in range(m+1)]
+        ins_extend=[min(gap_extend[max(j-1, 0)], gap_extend[min(j, m-1)]) for j in range(m+1)]
+        # match/deletion/insertion scores of the previous row and traceback pointers for every cell
+        M_prev, D_prev, I_prev=[0]*(m+1), [NEG]*(m+1), [NEG]*(m+1)
+        M_ptr, D_ptr, I_ptr=[None], [None], [None]
+        best, best_cell=0, (0, 0)
+        for i in range(1, n+1):
+            a=aaseq[i-1]
+            M_row, D_row, I_row=[0]+[NEG]*m, [NEG]*(m+1), [NEG]*(m+1)
+            M_p, D_p, I_p=bytearray(m+1), bytearray(m+1), bytearray(m+1)
+            for j in range(1, m+1):
+                # match: 0 from M, 1 from D, 2 from I
+                m_score, m_from=M_prev[j-1], 0
+                if D_prev[j-1]>m_score:
+                    m_score, m_from=D_prev[j-1], 1
+                if I_prev[j-1]>m_score:
+                    m_score, m_from=I_prev[j-1], 2
+                M_row[j]=m_score+BLOSUM62.get((a, residues[j-1]), -4)
+                M_p[j]=m_from
+                # deletion of template position j
+                d_score, d_from=M_row[j-1]-gap_open[j-1], 0
+                if D_row[j-1]-gap_extend[j-1]>d_score:
+                    d_score, d_from=D_row[j-1]-gap_extend[j-1], 1
+                if I_row[j-1]-gap_open[j-1]>d_score:
+                    d_score, d_from=I_row[j-1]-gap_open[j-1], 2
+                D_row[j]=d_score
+                D_p[j]=d_from
+                # insertion of query residue i after template position j
+                i_score, i_from=M_prev[j]-ins_open[j], 0
+                if I_prev[j]-ins_extend[j]>i_score:
+                    i_score, i_from=I_prev[j]-ins_extend[j], 2
+                if D_prev[j]-ins_open[j]>i_score:
+                    i_score, i_from=D_prev[j]-ins_open[j], 1
+                I_row[j]=i_score
+                I_p[j]=i_from
+            M_ptr.append(M_p)
+            D_ptr.append(D_p)
+            I_ptr.append(I_p)
+            if M_row[m]>best:
+                best, best_cell=M_row[m], (i, m)
+            M_prev, D_prev, I_prev=M_row, D_row, I_row
+        for j in range(1, m+1):
+            if M_prev[j]>best:
+                best, best_cell=M_prev[j], (n, j)
+        # walk back from the best end cell, unaligned query ends stay None
+        mapping=[None]*n
+        i, j=best_cell
+        state=0
+        while i>0 and j>0:
+            if state==0:
+                mapping[i-1]=j-1
+                state=M_ptr[i][j]
+                i, j=i-1, j-1
+            elif state==1:
+                state=D_ptr[i][j]
+                j-=1
+            else:
+                mapping[i-1]=("ins", j)
+                state=I_ptr[i][j]
+                i-=1
+        return [best, mapping]
+
+    def number(self, aaseq, scheme):
+        """
+        Number one sequence
+        :param aaseq: STRING, amino acid sequence
+        :param scheme: STRING, kabat, chothia or martin
+        :return: LIST, alternating position labels and residues, e.g. ["H1", "Q", "H2", "V", ...], empty if the sequence is not a V domain
+        """
+        start=metrics.start()
+        lst=self._number(aaseq, scheme)
+        metrics.stop("local_numbering", start)
+        return lst
+
+    def _number(self, aaseq, scheme):
+        aaseq="".join(aaseq.split()).upper()
+        alignments={chain_type: self.align(aaseq, chain_type) for chain_type in self.templates}
+        chain_type=max(alignments, key=lambda chain_type: alignments[chain_type][0])
+        score, mapping=alignments[chain_type]
+        if score<self.min_score:
+            return []
+        chain="H" if chain_type=="H" else "L"
+        regions=LOCAL_TEMPLATES[chain_type]
+        region_index=self.templates[chain_type][1]
+
+        # sort the query residues into template regions, insertions at a FR/CDR border go to the CDR
+        members=[[] for region in regions]
+        for i, j in enumerate(mapping):
+            if j is None:
+                continue
+            if isinstance(j, tuple):
+                after=j[1]
+                left=region_index[after-1] if after>0 else None
+                right=region_index[after] if after<len(region_index) else None
+                if left is None or (right is not None and regions[left][2] and not regions[right][2]):
+                    region=right
+                else:
+                    region=left
+                members[region].append((i, None))
+            else:
+                members[region_index[j]].append((i, j))
+
+        lst=[]
+        offset=0
+        for index, (region, consensus, fr_labels) in enumerate(regions):
+            if fr_labels:
+                labels=fr_labels.get(scheme, fr_labels[""])
+                previous=chain+"0"
+                for i, j in members[index]:
+                    if j is None:
+                        label=self.insertion_label(previous, lst)
+                    else:
+                        label=labels[j-offset]
+                    lst.extend([label, aaseq[i]])
+                    previous=label
+            else:
+                for (i, j), label in zip(members[index], self.cdr_labels(chain, region, scheme, len(members[index]))):
+                    lst.extend([label, aaseq[i]])
+            offset+=len(consensus)
+        return lst
+
+    @staticmethod
+    def insertion_label(previous, lst):
+        base=re.match("[HL][0-9]+", previous).group(0)
+        for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+            if base+letter not in lst[0::2]:
+                return base+letter
+        return base
+
+    @staticmethod
+    def cdr_labels(chain, region, scheme, length):
+        """
+        Number a CDR from its length
+        :param chain: STRING, "H" or "L"
+        :param region: STRING, "CDR1", "CDR2" or "CDR3"
+        :param scheme: STRING, kabat, chothia or martin
+        :param length: INT, number of residues in the CDR
+        :return: LIST, position labels in sequence order
+        """
+        core, insert_after, deletions=LOCAL_CDR_RULES.get((chain, region, scheme), LOCAL_CDR_RULES[chain, region, ""])
+        numbers=list(core)
+        for number in deletions:
+            if len(numbers)<=length:
+                break
+            numbers.remove(number)
+        labels=[]
+        for number in numbers:
+            labels.append(chain+str(number))
+            if number==insert_after:
+                labels.extend([chain+str(number)+letter for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"[:max(0, length-len(core))]])
+        return labels
+
+backend=abnum_backend()
 
 class annotate():
 
@@ -61,201 +699,1014 @@ class annotate():
 
         self.chain=chain
         self.lst=lst
-        if self.chain=="L":
-            self.L_FR1, self.L_CDR1, self.L_FR2, self.L_CDR2, self.L_FR3, self.L_CDR3, self.L_FR4=["" for i in range (0, 7)]
+        table=SCHEMES.get(self.scheme, SCHEMES["imgt"])
 
-            try:
-                if self.scheme in ["kabat", "chothia"]:
-                    self.L_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("L24"), 2)])
-                    self.L_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("L24"), self.lst.index("L35"), 2)])
-                    self.L_FR2="".join([self.lst[i+1] for i in range (self.lst.index("L35"), self.lst.index("L50"), 2)])
-                    self.L_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("L50"), self.lst.index("L57"), 2)])
-                    self.L_FR3="".join([self.lst[i+1] for i in range (self.lst.index("L57"), self.lst.index("L89"), 2)])
-                    self.L_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("L89"), self.lst.index("L98"), 2)])
-                    self.L_FR4="".join([self.lst[i+1] for i in range (self.lst.index("L98"), len(self.lst), 2)])
-
-                elif self.scheme =="contact":
-                    self.L_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("L30"), 2)])
-                    self.L_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("L30"), self.lst.index("L37"), 2)])
-                    self.L_FR2="".join([self.lst[i+1] for i in range (self.lst.index("L37"), self.lst.index("L46"), 2)])
-                    self.L_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("L46"), self.lst.index("L56"), 2)])
-                    self.L_FR3="".join([self.lst[i+1] for i in range (self.lst.index("L56"), self.lst.index("L89"), 2)])
-                    self.L_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("L89"), self.lst.index("L97"), 2)])
-                    self.L_FR4="".join([self.lst[i+1] for i in range (self.lst.index("L97"), len(self.lst), 2)])
-
-                elif self.scheme =="martin":
-                    self.L_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("L24"), 2)])
-                    self.L_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("L24"), self.lst.index("L34"), 2)])
-                    self.L_FR2="".join([self.lst[i+1] for i in range (self.lst.index("L34"), self.lst.index("L50"), 2)])
-                    self.L_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("L50"), self.lst.index("L56"), 2)])
-                    self.L_FR3="".join([self.lst[i+1] for i in range (self.lst.index("L56"), self.lst.index("L89"), 2)])
-                    self.L_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("L89"), self.lst.index("L97"), 2)])
-                    self.L_FR4="".join([self.lst[i+1] for i in range (self.lst.index("L97"), len(self.lst), 2)])
-
-                else: #IMGT scheme
-                    self.L_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("L27"), 2)])
-                    self.L_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("L27"), self.lst.index("L33"), 2)])
-                    self.L_FR2="".join([self.lst[i+1] for i in range (self.lst.index("L33"), self.lst.index("L50"), 2)])
-                    self.L_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("L50"), self.lst.index("L52"), 2)])
-                    self.L_FR3="".join([self.lst[i+1] for i in range (self.lst.index("L52"), self.lst.index("L89"), 2)])
-                    self.L_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("L89"), self.lst.index("L98"), 2)])
-                    self.L_FR4="".join([self.lst[i+1] for i in range (self.lst.index("L98"), len(self.lst), 2)])
-
-                return [self.L_FR1, self.L_CDR1, self.L_FR2, self.L_CDR2, self.L_FR3, self.L_CDR3, self.L_FR4]
-
-            except ValueError:
-                print("Unable to retrieve complete V region. Make sure the sequence has complete V region")
-            except:
-                print("An error occured")
-        else:
-            self.H_FR1, self.H_CDR1, self.H_FR2, self.H_CDR2, self.H_FR3, self.H_CDR3, self.H_FR4=["" for i in range (0, 7)]
+        try:
+            numbered=set(self.lst[0::2])
+            for boundary in table.boundaries[self.chain]:
+                if boundary not in numbered:
+                    raise ValueError(boundary)
+            regions=[[] for region in REGION_NAMES]
+            for i in range(0, len(self.lst), 2):
+                regions[table.region_of(self.chain, self.lst[i])].append(self.lst[i+1])
+            regions=["".join(region) for region in regions]
+            for region, seq in zip(REGION_NAMES, regions):
+                setattr(self, self.chain+"_"+region, seq)
+            return regions
 
-            try:
-                if self.scheme=="kabat":
-                    self.H_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("H31"), 2)])
-                    self.H_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("H31"), self.lst.index("H36"), 2)])
-                    self.H_FR2="".join([self.lst[i+1] for i in range (self.lst.index("H36"), self.lst.index("H50"), 2)])
-                    self.H_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("H50"), self.lst.index("H66"), 2)])
-                    self.H_FR3="".join([self.lst[i+1] for i in range (self.lst.index("H66"), self.lst.index("H95"), 2)])
-                    self.H_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("H95"), self.lst.index("H103"), 2)])
-                    self.H_FR4="".join([self.lst[i+1] for i in range (self.lst.index("H103"), len(self.lst), 2)])
-
-                elif self.scheme=="chothia":
-                    self.H_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("H26"), 2)])
-                    self.H_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("H26"), self.lst.index("H33"), 2)])
-                    self.H_FR2="".join([self.lst[i+1] for i in range (self.lst.index("H33"), self.lst.index("H52"), 2)])
-                    self.H_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("H52"), self.lst.index("H57"), 2)])
-                    self.H_FR3="".join([self.lst[i+1] for i in range (self.lst.index("H57"), self.lst.index("H95"), 2)])
-                    self.H_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("H95"), self.lst.index("H103"), 2)])
-                    self.H_FR4="".join([self.lst[i+1] for i in range (self.lst.index("H103"), len(self.lst), 2)])
-
-                elif self.scheme=="contact":
-                    self.H_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("H30"), 2)])
-                    self.H_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("H30"), self.lst.index("H36"), 2)])
-                    self.H_FR2="".join([self.lst[i+1] for i in range (self.lst.index("H36"), self.lst.index("H47"), 2)])
-                    self.H_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("H47"), self.lst.index("H59"), 2)])
-                    self.H_FR3="".join([self.lst[i+1] for i in range (self.lst.index("H59"), self.lst.index("H93"), 2)])
-                    self.H_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("H93"), self.lst.index("H102"), 2)])
-                    self.H_FR4="".join([self.lst[i+1] for i in range (self.lst.index("H102"), len(self.lst), 2)])
-
-                elif self.scheme=="martin":
-                    self.H_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("H26"), 2)])
-                    self.H_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("H31"), self.lst.index("H35"), 2)])
-                    self.H_FR2="".join([self.lst[i+1] for i in range (self.lst.index("H35"), self.lst.index("H50"), 2)])
-                    self.H_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("H50"), self.lst.index("H65"), 2)])
-                    self.H_FR3="".join([self.lst[i+1] for i in range (self.lst.index("H65"), self.lst.index("H95"), 2)])
-                    self.H_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("H95"), self.lst.index("H102"), 2)])
-                    self.H_FR4="".join([self.lst[i+1] for i in range (self.lst.index("H102"), len(self.lst), 2)])
-
-                else: #IMGT scheme
-                    self.H_FR1="".join([self.lst[i+1] for i in range (0, self.lst.index("H26"), 2)])
-                    self.H_CDR1="".join([self.lst[i+1] for i in range (self.lst.index("H26"), self.lst.index("H34"), 2)])
-                    self.H_FR2="".join([self.lst[i+1] for i in range (self.lst.index("H34"), self.lst.index("H51"), 2)])
-                    self.H_CDR2="".join([self.lst[i+1] for i in range (self.lst.index("H51"), self.lst.index("H58"), 2)]) #51>57 (instead of 56)
-                    self.H_FR3="".join([self.lst[i+1] for i in range (self.lst.index("H58"), self.lst.index("H93"), 2)])
-                    self.H_CDR3="".join([self.lst[i+1] for i in range (self.lst.index("H93"), self.lst.index("H103"), 2)])
-                    self.H_FR4="".join([self.lst[i+1] for i in range (self.lst.index("H103"), len(self.lst), 2)])
-
-                return [self.H_FR1, self.H_CDR1, self.H_FR2, self.H_CDR2, self.H_FR3, self.H_CDR3, self.H_FR4]
-
-            except ValueError:
-                print("Unable to retrieve complete V region. Make sure the sequence has complete V region")
-            except:
-                print("An error occured in the `analyze()` method")
+        except ValueError:
+            metrics.failure("incomplete_v_region")
+            print("Unable to retrieve complete V region. Make sure the sequence has complete V region")
+        except Exception as e:
+            metrics.failure("analyze_error")
+            print("An error occured in the `analyze()` method: "+repr(e))
 
     def retrieve (self):
 
-        self.url="http://www.bioinf.org.uk/abs/abnum/abnum.cgi"
+        self.url=client.url
 
         try:
-            if self.scheme not in ["kabat", "chothia", "contact", "imgt", "martin"]:
-                raise Exception
+            if self.scheme not in SCHEMES:
+                raise ValueError("unknown numbering scheme "+str(self.scheme))
 
         except ValueError:
-            print("Incorrect scheme mode. Must be one of the following (lowercase): kabat, chothia, contact, imgt")
+            metrics.failure("unknown_scheme")
+            print("Incorrect scheme mode. Must be one of the following (lowercase): kabat, chothia, martin, contact, imgt")
+            return None
 
         else:
-            if self.scheme=="kabat":
-                self.sche="-k"
-            elif self.scheme=="chothia":
-                self.sche="-c"
-            elif self.scheme=="martin":
-                self.sche="-m"
+            self.numbering=SCHEMES[self.scheme].numbering
+            self.sche=SCHEME_FLAGS[self.numbering]
 
         try:
-            self.d={"plain":1, "scheme":self.sche, "aaseq":self.aaseq}
-            self.myPage=requests.get(self.url, params=self.d)
-            self.text=self.myPage.text
-            self.lst=self.text.split()
+            self.lst=cache.get(self.aaseq, backend.cache_tag+self.numbering) if cache is not None else None
+            if self.lst is None:
+                self.lst=backend.number(self.aaseq, self.numbering)
+                if cache is not None and len(self.lst)>1:
+                    cache.put(self.aaseq, backend.cache_tag+self.numbering, self.lst)
 
             if len(self.lst)>1:
+                start=metrics.start()
                 self.chain=self.lst[0][0]
-                self.result=self.output(self.chain, self.lst, self.analyze(self.chain, self.lst))
+                self.regionlst=self.analyze(self.chain, self.lst)
+                if self.regionlst is None:
+                    return None
+                self.result=self.output(self.chain, self.lst, self.regionlst)
+                metrics.stop("parse", start)
                 return self.result
             else:
+                metrics.failure("empty_response")
                 print("No annotation retrieved. Did you enter the complete VH or VL sequence?")
-        except:
-            print("An error occured in the `retrieve()` method")
+        except requests.RequestException as e:
+            metrics.failure("http_error")
+            print("An error occured in the `retrieve()` method: "+repr(e))
+        except Exception as e:
+            metrics.failure("retrieve_error")
+            print("An error occured in the `retrieve()` method: "+repr(e))
 
-def get_spaced_sequence(Heavy_seq, Light_seq, scheme):
-    try:
-        seq1=annotate(Heavy_seq,scheme)
-        heavy_sequence_split = seq1.retrieve()[0]
-        heavy_sequence_num   = seq1.retrieve()[1]
-        heavy_sequence_num_list = list(heavy_sequence_num.keys())
-        seq2=annotate(Light_seq,scheme)
-        light_sequence_split = seq2.retrieve()[0]
-        light_sequence_num   = seq2.retrieve()[1]
-        light_sequence_num_list = list(light_sequence_num.keys())
-
-
-        if scheme == 'kabat':
-            Heavy_sorter = ['H1','H2','H3','H4','H5','H6','H7','H8','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H32','H33','H34','H35','H35A','H35B','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H82A','H82B','H82C','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113']
-            Light_sorter = ['L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L27A','L27B','L27C','L27D','L27E','L27F','L28','L29','L30','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L69','L70','L71''L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L106A','L107','L108','L109']
-        elif scheme == 'chothia':
-            Heavy_sorter = ['H1','H2','H3','H4','H5','H6','H7','H8','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H31A','H31B','H32','H33','H34','H35','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H82A','H82B','H82C','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113']
-            Light_sorter = ['L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L28','L29','L30','L30A','L30B','L30C','L30D','L30E','L30F','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L69','L70','L71','L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L106A','L107','L108','L109']
-        elif scheme == 'martin':
-            Heavy_sorter = ['H1','H2','H3','H4','H5','H6','H7','H8','H8A','H8B','H8C','H8D','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H31A','H31B','H32','H33','H34','H35','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H72A','H72B','H72C','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113']
-            Light_sorter = ['L0','L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L28','L29','L30','L30A','L30B','L30C','L30D','L30E','L30F','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L40A','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L52A','L52B','L52C','L52D','L52E','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L68A','L68B','L68C','L68D','L68E','L68F','L68G','L68H','L69','L70','L71','L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L107','L107A','L108','L109','L110']
+SORTERS = {
+    'kabat': (['H1','H2','H3','H4','H5','H6','H7','H8','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H32','H33','H34','H35','H35A','H35B','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H82A','H82B','H82C','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113'],
+               ['L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L27A','L27B','L27C','L27D','L27E','L27F','L28','L29','L30','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L69','L70','L71','L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L106A','L107','L108','L109']),
+    'chothia': (['H1','H2','H3','H4','H5','H6','H7','H8','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H31A','H31B','H32','H33','H34','H35','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H82A','H82B','H82C','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113'],
+               ['L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L28','L29','L30','L30A','L30B','L30C','L30D','L30E','L30F','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L69','L70','L71','L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L106A','L107','L108','L109']),
+    'martin': (['H1','H2','H3','H4','H5','H6','H7','H8','H8A','H8B','H8C','H8D','H9','H10','H11','H12','H13','H14','H15','H16','H17','H18','H19','H20','H21','H22','H23','H24','H25','H26','H27','H28','H29','H30','H31','H31A','H31B','H32','H33','H34','H35','H36','H37','H38','H39','H40','H41','H42','H43','H44','H45','H46','H47','H48','H49','H50','H51','H52','H52A','H52B','H52C','H53','H54','H55','H56','H57','H58','H59','H60','H61','H62','H63','H64','H65','H66','H67','H68','H69','H70','H71','H72','H72A','H72B','H72C','H73','H74','H75','H76','H77','H78','H79','H80','H81','H82','H83','H84','H85','H86','H87','H88','H89','H90','H91','H92','H93','H94','H95','H96','H97','H98','H99','H100','H100A','H100B','H100C','H100D','H100E','H100F','H100G','H100H','H100I','H100J','H100K','H101','H102','H103','H104','H105','H106','H107','H108','H109','H110','H111','H112','H113'],
+               ['L0','L1','L2','L3','L4','L5','L6','L7','L8','L9','L10','L11','L12','L13','L14','L15','L16','L17','L18','L19','L20','L21','L22','L23','L24','L25','L26','L27','L28','L29','L30','L30A','L30B','L30C','L30D','L30E','L30F','L31','L32','L33','L34','L35','L36','L37','L38','L39','L40','L40A','L41','L42','L43','L44','L45','L46','L47','L48','L49','L50','L51','L52','L52A','L52B','L52C','L52D','L52E','L53','L54','L55','L56','L57','L58','L59','L60','L61','L62','L63','L64','L65','L66','L67','L68','L68A','L68B','L68C','L68D','L68E','L68F','L68G','L68H','L69','L70','L71','L72','L73','L74','L75','L76','L77','L78','L79','L80','L81','L82','L83','L84','L85','L86','L87','L88','L89','L90','L91','L92','L93','L94','L95','L95A','L95B','L95C','L95D','L95E','L95F','L96','L97','L98','L99','L100','L101','L102','L103','L104','L105','L106','L107','L107A','L108','L109','L110']),
+}
+
+SORTERS['contact'] = SORTERS['chothia']
+SORTERS['imgt'] = SORTERS['chothia']
+
+REGION_NAMES = ["FR1", "CDR1", "FR2", "CDR2", "FR3", "CDR3", "FR4"]
+
+def _position_key(label):
+    match=re.match("[HL]([0-9]+)([A-Z]*)$", label)
+    return (int(match.group(1)), match.group(2))
+
+class scheme_index():
+    """
+    Tables for one scheme, built once: the numbering AbNum is asked for, the ordered positions
+    of each chain, position -> column dicts for spacing and the first position of each region after
+    FR1 (CDR1, FR2, CDR2, FR3, CDR3, FR4) for splitting a numbering into FR and CDR regions.
+    """
+
+    def __init__(self, name, numbering, heavy_boundaries, light_boundaries):
+
+        self.name=name
+        self.numbering=numbering
+        self.positions={"H":SORTERS[name][0], "L":SORTERS[name][1]}
+        self.columns={chain: {label: column for column, label in enumerate(positions)} for chain, positions in self.positions.items()}
+        self.boundaries={"H":heavy_boundaries, "L":light_boundaries}
+        self.boundary_keys={chain: [_position_key(label) for label in boundaries] for chain, boundaries in self.boundaries.items()}
+        self.regions={chain: {label: self._region(chain, label) for label in positions} for chain, positions in self.positions.items()}
+        self.width=len(self.positions["H"])+len(self.positions["L"])
+
+    def __repr__(self):
+        return "Scheme tables for "+self.name
+
+    def _region(self, chain, label):
+        return bisect.bisect_right(self.boundary_keys[chain], _position_key(label))
+
+    def region_of(self, chain, label):
+        """
+        Find which region a position is in
+        :param chain: STRING, "H" or "L"
+        :param label: STRING, position label such as H52A
+        :return: INT, index into REGION_NAMES
+        """
+        region=self.regions[chain].get(label)
+        if region is None:
+            region=self.regions[chain][label]=self._region(chain, label)
+        return region
+
+    def space(self, chain, numberdict):
+        """
+        Lay a numbered chain out on the scheme's positions, 'X' where a position is empty
+        :param chain: STRING, "H" or "L"
+        :param numberdict: DICT, position label: residue pairs
+        :return: STRING, spaced sequence
+        """
+        columns=self.columns[chain]
+        spaced=bytearray(b"X"*len(self.positions[chain]))
+        for label, residue in numberdict.items():
+            column=columns.get(label)
+            if column is not None:
+                spaced[column]=ord(residue)
+        return spaced.decode()
+
+# contact and IMGT regions are defined on the Chothia numbering
+SCHEMES = {
+    "kabat": scheme_index("kabat", "kabat", ["H31", "H36", "H50", "H66", "H95", "H103"], ["L24", "L35", "L50", "L57", "L89", "L98"]),
+    "chothia": scheme_index("chothia", "chothia", ["H26", "H33", "H52", "H57", "H95", "H103"], ["L24", "L35", "L50", "L57", "L89", "L98"]),
+    "martin": scheme_index("martin", "martin", ["H26", "H35", "H50", "H65", "H95", "H102"], ["L24", "L34", "L50", "L56", "L89", "L97"]),
+    "contact": scheme_index("contact", "chothia", ["H30", "H36", "H47", "H59", "H93", "H102"], ["L30", "L37", "L46", "L56", "L89", "L97"]),
+    "imgt": scheme_index("imgt", "chothia", ["H26", "H34", "H51", "H58", "H93", "H103"], ["L27", "L33", "L50", "L52", "L89", "L98"]),
+}
+
+def number_many(seqs, scheme, concurrency=4, executor=None):
+    """
+    Number many sequences at once, keeping at most `concurrency` AbNum requests in flight
+    :param seqs: LIST, amino acid sequences
+    :param scheme: STRING, numbering scheme
+    :param concurrency: INT, number of simultaneous requests
+    :param executor: ThreadPoolExecutor, long-lived pool to use instead of starting one for this call
+    :return: LIST, the `retrieve()` result for each sequence (None where numbering failed), in input order
+    """
+    if concurrency<=1 or len(seqs)<=1:
+        return [annotate(seq, scheme).retrieve() for seq in seqs]
+    if executor is not None:
+        return list(executor.map(lambda seq: annotate(seq, scheme).retrieve(), seqs))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda seq: annotate(seq, scheme).retrieve(), seqs))
+
+def get_spaced_sequences(pairs, scheme, jobs=1, encode=None):
+    """
+    Number and space a batch of heavy/light pairs
+    :param pairs: LIST, (heavy sequence, light sequence) tuples
+    :param scheme: STRING, numbering scheme
+    :param jobs: INT, number of simultaneous AbNum requests
+    :param encode: STRING, None for strings, "int" for a uint8 vector or "onehot" for a one-hot matrix per pair
+    :return: LIST, (spaced heavy, spaced light) tuples or encoded arrays, None for pairs that could not be numbered
+    """
+    planner=chain_planner()
+    batch=[(i, pair[0], pair[1]) for i, pair in enumerate(pairs)]
+    todo=planner.plan(batch)
+    planner.store(todo, space_chains(todo, scheme, jobs))
+    spaced=[pair for identifier, pair in planner.fan_out(batch)]
+    if encode is None:
+        return spaced
+    return [encode_spaced(pair[0], pair[1], onehot=encode=="onehot") if pair is not None else None for pair in spaced]
+
+def get_spaced_sequence(Heavy_seq, Light_seq, scheme, jobs=2, encode=None):
+    return get_spaced_sequences([(Heavy_seq, Light_seq)], scheme, jobs=jobs, encode=encode)[0]
+
+def space_chains(chains, scheme, jobs=1, executor=None):
+    """
+    Number and space individual chains
+    :param chains: LIST, ("H" or "L", sequence) tuples
+    :param scheme: STRING, numbering scheme
+    :param jobs: INT, number of simultaneous AbNum requests
+    :param executor: ThreadPoolExecutor, long-lived pool for the requests
+    :return: LIST, spaced sequence for each chain, None where numbering failed
+    """
+    numbered=number_many([seq for chain, seq in chains], scheme, concurrency=jobs, executor=executor)
+    spaced=[]
+    for (chain, seq), result in zip(chains, numbered):
+        if result is None:
+            spaced.append(None)
+            continue
+        start=metrics.start()
+        try:
+            spaced.append(SCHEMES[scheme].space(chain, result[1]))
+        except Exception as e:
+            metrics.failure("spacing_error")
+            print("An error occured while spacing: "+repr(e))
+            spaced.append(None)
+            continue
+        metrics.stop("spacing", start)
+    return spaced
+
+_PENDING = object()
+
+class chain_planner():
+    """
+    Deduplicates chains across a run. `plan()` interns the heavy and light chains of a batch and
+    returns only those never seen before, `store()` takes their spaced sequences and `fan_out()`
+    hands every pair its chains, so a chain shared by many pairs is numbered and spaced once and
+    all of them point at the same string. Up to `max_entries` spaced chains are remembered, least
+    recently used first out; chains still needed by a batch in flight are never dropped. A chain
+    that could not be numbered is only shared with the batches already waiting for it and then
+    forgotten, so a later batch tries it again.
+    """
+
+    def __init__(self, max_entries=200000):
+
+        self.max_entries=max_entries
+        self.memo=OrderedDict()
+        self.pins=Counter()
+        self.chains=0
+        self.numbered=0
+
+    def __repr__(self):
+        return "Chain planner (%d chains, %d numbered)" % (self.chains, self.numbered)
+
+    def plan(self, batch):
+        """
+        :param batch: LIST, (identifier, heavy sequence, light sequence) tuples
+        :return: LIST, ("H" or "L", sequence) tuples that still have to be numbered
+        """
+        todo=[]
+        for identifier, heavy, light in batch:
+            for key in (("H", heavy), ("L", light)):
+                self.chains+=1
+                if key in self.memo:
+                    self.memo.move_to_end(key)
+                else:
+                    self.memo[key]=_PENDING
+                    todo.append(key)
+                self.pins[key]+=1
+        return todo
+
+    def store(self, todo, spaced):
+        """
+        :param todo: LIST, chains returned by `plan()`
+        :param spaced: LIST, their spaced sequences (None where numbering failed)
+        """
+        for key, value in zip(todo, spaced):
+            self.memo[key]=value
+        self.numbered+=len(todo)
+
+    def fan_out(self, batch):
+        """
+        :param batch: LIST, the batch given to `plan()`, once `store()` has been called for it and every earlier batch
+        :return: LIST, (identifier, (spaced heavy, spaced light) or None) in batch order
+        """
+        spaced=[]
+        for identifier, heavy, light in batch:
+            spaced_heavy, spaced_light=self.memo[("H", heavy)], self.memo[("L", light)]
+            self.unpin(("H", heavy))
+            self.unpin(("L", light))
+            spaced.append((identifier, (spaced_heavy, spaced_light) if spaced_heavy is not None and spaced_light is not None else None))
+        self.trim()
+        return spaced
+
+    def unpin(self, key):
+        self.pins[key]-=1
+        if not self.pins[key]:
+            del self.pins[key]
+            # failures are not memoised, the next batch with this chain numbers it again
+            if key in self.memo and self.memo[key] is None:
+                del self.memo[key]
+
+    def trim(self):
+        skipped=0
+        while len(self.memo)>self.max_entries and skipped<len(self.memo):
+            key=next(iter(self.memo))
+            if key in self.pins:
+                self.memo.move_to_end(key)
+                skipped+=1
+            else:
+                del self.memo[key]
+
+    def ratio(self):
+        """
+        :return: FLOAT, chains seen per chain numbered
+        """
+        return self.chains/float(self.numbered) if self.numbered else 1.0
+
+def check_agreement(path=RECORDED_RESPONSES):
+    """
+    Compare the local numbering engine with recorded reference numberings
+    :param path: STRING, JSON file of {"scheme", "aaseq", "response", "source"} records
+    :return: INT, number of sequences where the local numbering differs from the reference
+    """
+    with open(path) as f:
+        records=json.load(f)
+    engine=local_backend()
+    mismatches=Counter()
+    totals=Counter()
+    for record in records:
+        expected=record["response"].split()
+        numbered=engine.number(record["aaseq"], record["scheme"])
+        totals[record["scheme"]]+=1
+        if numbered!=expected:
+            mismatches[record["scheme"]]+=1
+            differences=[(expected[i:i+2], numbered[i:i+2]) for i in range(0, max(len(expected), len(numbered)), 2) if expected[i:i+2]!=numbered[i:i+2]]
+            print("Mismatch for "+record["aaseq"]+" ("+record["scheme"]+"), first difference "+record.get("source", "AbNum").split()[0]+" "+str(differences[0][0])+" local "+str(differences[0][1]))
+    for scheme in sorted(totals):
+        print("%s: %d of %d recorded numberings reproduced by the local engine" % (scheme, totals[scheme]-mismatches[scheme], totals[scheme]))
+    return sum(mismatches.values())
+
+# 'X' (a space in the numbering, or an unknown residue) is 0, the 20 amino acids are 1-20
+ENCODING_ALPHABET = "XACDEFGHIKLMNPQRSTVWY"
+ENCODING_TABLE = bytearray(256)
+for _code, _residue in enumerate(ENCODING_ALPHABET):
+    ENCODING_TABLE[ord(_residue)]=_code
+    ENCODING_TABLE[ord(_residue.lower())]=_code
+ENCODING_TABLE = bytes(ENCODING_TABLE)
+
+def encode_spaced(spaced_heavy, spaced_light, onehot=False):
+    """
+    Encode a spaced pair as integers
+    :param spaced_heavy: STRING, spaced heavy chain
+    :param spaced_light: STRING, spaced light chain
+    :param onehot: BOOL, return a one-hot matrix instead of a vector of codes
+    :return: numpy array, uint8 codes of length len(heavy)+len(light), or (length x 21) one-hot matrix
+    """
+    codes=np.frombuffer((spaced_heavy+spaced_light).encode().translate(ENCODING_TABLE), dtype=np.uint8)
+    if onehot:
+        return np.eye(len(ENCODING_ALPHABET), dtype=np.uint8)[codes]
+    return codes
+
+class fasta_writer():
+    """
+    Writes spaced pairs as a paired fasta file. `resume` is a state previously returned by
+    `state()`; the file is cut back to that point and appended to.
+    """
+
+    def __init__(self, path, buffer_size=1<<20, resume=None):
+
+        self.path=path
+        self.count=0
+        if resume is None:
+            self.f=open(path, "wb", buffering=buffer_size)
+        else:
+            os.truncate(path, resume["offset"])
+            self.count=resume["count"]
+            self.f=open(path, "ab", buffering=buffer_size)
+
+    def write(self, identifier, spaced_sequences):
+        self.f.write((">"+identifier+"_H|"+identifier+"\n"+spaced_sequences[0]+"\n>"+identifier+"_L|"+identifier+"\n"+spaced_sequences[1]+"\n").encode())
+        self.count+=1
+
+    def state(self):
+        """
+        Flush what has been written and report how far the output has got
+        :return: DICT, enough to resume writing after a crash
+        """
+        self.f.flush()
+        return {"count":self.count, "offset":self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+class encoded_writer():
+    """
+    Streams spaced pairs into a .npy file, one uint8 row per pair (codes from ENCODING_ALPHABET,
+    or one-hot rows for format "onehot"). Rows are appended as they arrive behind a fixed-size header
+    whose shape is filled in on close, so the result can be opened with np.load(path, mmap_mode="r").
+    Pair identifiers go to a side index, `<path>.ids.txt`, one per line in row order. Format "npz"
+    streams the same way into a temporary .npy and packs the codes and identifiers into a
+    compressed archive (arrays "X" and "ids") on close.
+    """
+
+    header_size=128
+
+    def __init__(self, path, scheme, format="npy", buffer_size=1<<20, resume=None):
+
+        self.path=path
+        self.format=format
+        self.count=0
+        self.width=SCHEMES[scheme].width
+        self.shape_tail=(self.width, len(ENCODING_ALPHABET)) if format=="onehot" else (self.width,)
+        if format=="onehot":
+            self.onehot=np.eye(len(ENCODING_ALPHABET), dtype=np.uint8)
+        self.array_path=path+".tmp.npy" if format=="npz" else path
+        self.ids_path=path+".ids.txt"
+        if resume is None:
+            self.f=open(self.array_path, "wb", buffering=buffer_size)
+            self.f.write(self.header(0))
+            self.ids=open(self.ids_path, "wb", buffering=buffer_size)
+        else:
+            self.count=resume["count"]
+            os.truncate(self.array_path, self.header_size+self.count*self.row_size())
+            os.truncate(self.ids_path, resume["ids_offset"])
+            self.f=open(self.array_path, "r+b", buffering=buffer_size)
+            self.f.seek(0, os.SEEK_END)
+            self.ids=open(self.ids_path, "ab", buffering=buffer_size)
+
+    def header(self, rows):
+        """
+        Build a version 1.0 .npy header padded to `header_size` bytes
+        :param rows: INT, number of rows written so far
+        :return: BYTES, the header
+        """
+        text="{'descr': '|u1', 'fortran_order': False, 'shape': %r, }" % ((rows,)+self.shape_tail,)
+        text=text.ljust(self.header_size-11)+"\n"
+        return b"\x93NUMPY\x01\x00"+len(text).to_bytes(2, "little")+text.encode("latin1")
+
+    def write(self, identifier, spaced_sequences):
+        codes=(spaced_sequences[0]+spaced_sequences[1]).encode().translate(ENCODING_TABLE)
+        if len(codes)!=self.width:
+            raise ValueError("spaced pair "+identifier+" has length "+str(len(codes))+", expected "+str(self.width))
+        if self.format=="onehot":
+            codes=self.onehot[np.frombuffer(codes, dtype=np.uint8)].tobytes()
+        self.write_row(identifier, codes)
+
+    def write_row(self, identifier, row):
+        """
+        Append an already encoded row
+        :param identifier: STRING, pair identifier
+        :param row: BYTES, `row_size()` bytes in this writer's format
+        """
+        if len(row)!=self.row_size():
+            raise ValueError("row for "+identifier+" has "+str(len(row))+" bytes, expected "+str(self.row_size()))
+        self.f.write(row)
+        self.ids.write((identifier+"\n").encode())
+        self.count+=1
+
+    def row_size(self):
+        size=1
+        for dimension in self.shape_tail:
+            size*=dimension
+        return size
+
+    def state(self):
+        """
+        Flush what has been written and report how far the output has got
+        :return: DICT, enough to resume writing after a crash
+        """
+        self.f.flush()
+        self.ids.flush()
+        return {"count":self.count, "ids_offset":self.ids.tell()}
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(self.header(self.count))
+        self.f.close()
+        self.ids.close()
+        if self.format=="npz":
+            with open(self.ids_path) as f:
+                ids=np.array(f.read().split("\n")[:-1])
+            np.savez_compressed(self.path, X=np.load(self.array_path, mmap_mode="r"), ids=ids)
+            if not self.path.endswith(".npz"):
+                os.replace(self.path+".npz", self.path)
+            os.remove(self.array_path)
+            os.remove(self.ids_path)
+
+def read_fasta(path):
+    """
+    Stream records from a fasta file, plain or gzip compressed, with sequences on one or many lines
+    :param path: STRING, path to a .fa or .fa.gz file
+    :return: GENERATOR, (header, sequence) tuples, header without the leading '>'
+    """
+    with open(path, "rb") as raw, io.TextIOWrapper(gzip.GzipFile(fileobj=raw) if path.endswith(".gz") else raw) as f:
+        metrics.input_size=os.fstat(raw.fileno()).st_size
+        header, parts=None, []
+        records=0
+        for line in f:
+            line=line.strip()
+            if not line:
+                continue
+            if line[0]==">":
+                if header is not None:
+                    yield header, "".join(parts)
+                    records+=1
+                    if records % 1000 == 0:
+                        metrics.input_position=raw.tell()
+                header, parts=line[1:], []
+            else:
+                parts.append(line)
+        if header is not None:
+            metrics.input_position=metrics.input_size
+            yield header, "".join(parts)
+
+def chain_of(header):
+    """
+    Work out which chain a fasta heading belongs to
+    :param header: STRING, fasta heading such as 8E10_VH|8E10
+    :return: STRING, "H", "L", or None if the heading names neither
+    """
+    if "_H|" in header or "_VH|" in header:
+        return "H"
+    if "_L|" in header or "_VL|" in header:
+        return "L"
+    return None
+
+def pair_records(records, window=10000, stats=None):
+    """
+    Pair heavy and light chains by the identifier after '|' in their headings, in either order and
+    not necessarily adjacent. At most `window` chains wait for their partner; beyond that the oldest
+    is given up as unpaired.
+    :param records: ITERABLE, (header, sequence) tuples
+    :param window: INT, maximum number of chains waiting for a partner
+    :param stats: Counter, receives "records", "pairs" and "unpaired" counts
+    :return: GENERATOR, (identifier, heavy sequence, light sequence) tuples in the order pairs complete
+    """
+    stats=stats if stats is not None else Counter()
+    waiting=OrderedDict()
+    for header, sequence in records:
+        stats["records"]+=1
+        chain=chain_of(header)
+        if chain is None or "|" not in header:
+            print("Skipping "+header+": heading does not name a heavy or light chain")
+            stats["unpaired"]+=1
+            continue
+        identifier=header.split("|")[1]
+        partner=waiting.get(identifier)
+        if partner is not None and partner[0]!=chain:
+            del waiting[identifier]
+            stats["pairs"]+=1
+            yield (identifier, sequence, partner[1]) if chain=="H" else (identifier, partner[1], sequence)
+            continue
+        if partner is not None:
+            print("Skipping "+identifier+": more than one "+chain+" chain")
+            stats["unpaired"]+=1
+        waiting[identifier]=(chain, sequence)
+        waiting.move_to_end(identifier)
+        if len(waiting)>window:
+            print("Skipping "+waiting.popitem(last=False)[0]+": no partner chain within "+str(window)+" records")
+            stats["unpaired"]+=1
+    for identifier in waiting:
+        print("Skipping "+identifier+": no partner chain found")
+        stats["unpaired"]+=1
+
+def batched(iterable, size):
+    batch=[]
+    for item in iterable:
+        batch.append(item)
+        if len(batch)>=size:
+            yield batch
+            batch=[]
+    if batch:
+        yield batch
+
+def shard_of(identifier, shards):
+    """
+    Deterministically assign a pair to a shard from its identifier
+    :param identifier: STRING, pair identifier
+    :param shards: INT, number of shards
+    :return: INT, shard index from 0 to shards-1
+    """
+    return zlib.crc32(identifier.encode()) % shards
+
+
+def _init_worker(settings):
+    # recreate the parent's numbering setup in a worker process
+    global backend, cache, client, metrics
+    backend=local_backend() if settings["engine"]=="local" else abnum_backend()
+    cache=open_cache(settings["cache"], settings["cache_size"]) if settings["cache"] is not None else None
+    client=abnum_client(url=settings["url"], pool_size=settings["jobs"], timeout=settings["timeout"], retries=settings["retries"], rate=settings["rate"])
+    metrics=run_metrics(enabled=settings["metrics"])
+
+def _space_chains_in_worker(chains, scheme, jobs):
+    return space_chains(chains, scheme, jobs), metrics.drain(), cache.drain() if cache is not None else (0, 0)
+
+def space_batches(batches, scheme, jobs=1, workers=1, settings=None, planner=None, stats=None):
+    """
+    Number and space batches of pairs, in this process or spread over a pool of worker processes.
+    Only chains the planner has not seen before are numbered.
+    :param batches: ITERABLE, lists of (identifier, heavy sequence, light sequence) tuples
+    :param scheme: STRING, numbering scheme
+    :param jobs: INT, number of simultaneous AbNum requests per process
+    :param workers: INT, number of worker processes, 1 to work in this process
+    :param settings: DICT, engine/cache/client settings handed to `_init_worker` in each worker
+    :param planner: chain_planner, deduplicates chains across batches
+    :param stats: Counter, receives the cache hits and misses of worker processes
+    :return: GENERATOR, one list of (identifier, spaced pair or None) per batch, in input order
+    """
+    planner=planner if planner is not None else chain_planner()
+    stats=stats if stats is not None else Counter()
+    if workers<=1:
+        for batch in batches:
+            todo=planner.plan(batch)
+            planner.store(todo, space_chains(todo, scheme, jobs))
+            yield planner.fan_out(batch)
+        return
+    # at most two batches per worker are in flight, results are handed back in submission order
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(settings,)) as pool:
+        pending=deque()
+        for batch in batches:
+            todo=planner.plan(batch)
+            pending.append((batch, todo, pool.apply_async(_space_chains_in_worker, (todo, scheme, jobs)) if todo else None))
+            while pending and (len(pending)>=2*workers or pending[0][2] is None):
+                yield _finish_batch(planner, stats, *pending.popleft())
+        while pending:
+            yield _finish_batch(planner, stats, *pending.popleft())
+
+def _finish_batch(planner, stats, batch, todo, result):
+    if result is not None:
+        spaced, measured, (hits, misses)=result.get()
+        metrics.merge(measured)
+        stats["cache_hits"]+=hits
+        stats["cache_misses"]+=misses
+        planner.store(todo, spaced)
+    return planner.fan_out(batch)
+
+def run_pipeline(input_fasta, writer, scheme, jobs=1, batch_size=256, window=10000, checkpoint=None, skip=0, progress=0, workers=1, settings=None, shard=None, planner=None):
+    """
+    Read, pair, number, space and write a paired fasta file in constant memory
+    :param input_fasta: STRING, path to a .fa or .fa.gz file
+    :param writer: fasta_writer or encoded_writer
+    :param scheme: STRING, numbering scheme
+    :param jobs: INT, number of simultaneous AbNum requests
+    :param batch_size: INT, pairs numbered and written together
+    :param window: INT, maximum number of chains waiting for a partner
+    :param checkpoint: STRING, file updated after every batch so an interrupted run can resume
+    :param skip: INT, pairs already written by a previous run
+    :param progress: FLOAT, seconds between progress lines on stderr, 0 for none
+    :param workers: INT, number of worker processes
+    :param settings: DICT, numbering setup for worker processes, see `_init_worker`
+    :param shard: TUPLE, (i, n) to process only the pairs in shard i of n
+    :param planner: chain_planner, deduplicates chains across the run
+    :return: Counter, records/pairs/unpaired/written/failed, chain and cache hit/miss counts
+    """
+    stats=Counter()
+    pairs=pair_records(read_fasta(input_fasta), window, stats)
+    if shard is not None:
+        pairs=(pair for pair in pairs if shard_of(pair[0], shard[1])==shard[0])
+    for i in range(skip):
+        next(pairs, None)
+    done=skip
+    last_progress=time.time()
+    planner=planner if planner is not None else chain_planner()
+    for batch in space_batches(batched(pairs, batch_size), scheme, jobs, workers, settings, planner, stats):
+        start=metrics.start()
+        for identifier, spaced_sequences in batch:
+            if spaced_sequences is not None:
+                writer.write(identifier, spaced_sequences)
+                stats["written"]+=1
+            else:
+                stats["failed"]+=1
+        done+=len(batch)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, {"input":os.path.abspath(input_fasta), "scheme":scheme, "shard":shard, "pairs_done":done, "writer":writer.state()})
+        metrics.stop("writing", start)
+        if progress and time.time()-last_progress>=progress:
+            print(metrics.progress(done-skip), file=sys.stderr)
+            last_progress=time.time()
+    stats["chains"]=planner.chains
+    stats["chains_numbered"]=planner.numbered
+    if cache is not None:
+        stats["cache_hits"], stats["cache_misses"]=cache.hits, cache.misses
+    metrics.counters.update(stats)
+    return stats
+
+def save_checkpoint(path, state):
+    with open(path+".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path+".tmp", path)
+
+def load_checkpoint(path, input_fasta, scheme, shard=None):
+    """
+    Read a checkpoint left by an interrupted run
+    :return: DICT, the saved state, or None if there is none for this input, scheme and shard
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state=json.load(f)
+    if state["input"]!=os.path.abspath(input_fasta) or state["scheme"]!=scheme or state.get("shard")!=(list(shard) if shard else None):
+        print("Ignoring checkpoint "+path+": it was written for a different input, scheme or shard")
+        return None
+    return state
+
+def read_shard(path, format):
+    """
+    Stream the pairs of one shard output
+    :param path: STRING, shard output file
+    :param format: STRING, fasta, npy, npz or onehot
+    :return: GENERATOR, (identifier, spaced pair) for fasta, (identifier, encoded row bytes) otherwise
+    """
+    if format=="fasta":
+        records=read_fasta(path)
+        for heavy, light in zip(records, records):
+            yield heavy[0].split("|")[1], (heavy[1], light[1])
+        return
+    if format=="npz":
+        archive=np.load(path)
+        rows, ids=archive["X"], archive["ids"]
+    else:
+        rows=np.load(path, mmap_mode="r")
+        with open(path+".ids.txt") as f:
+            ids=f.read().split("\n")[:-1]
+    for identifier, row in zip(ids, rows):
+        yield str(identifier), row.tobytes()
+
+def merge_shards(input_fasta, shard_paths, writer, format, window=10000):
+    """
+    Combine the outputs of `--shard i/n` runs back into input order. Every pair of the input is
+    looked up in the shard its identifier hashes to; pairs a shard could not number are skipped.
+    :param input_fasta: STRING, the input all shards were run on
+    :param shard_paths: LIST, shard outputs in shard order, 0 to n-1
+    :param writer: fasta_writer or encoded_writer for the merged output
+    :param format: STRING, format of the shard outputs
+    :param window: INT, pairing window used for the shard runs
+    :return: INT, pairs written
+    :raises: ValueError if the shards were encoded for another scheme than `writer`
+    """
+    readers=[read_shard(path, format) for path in shard_paths]
+    heads=[next(reader, None) for reader in readers]
+    if format!="fasta":
+        for path, head in zip(shard_paths, heads):
+            if head is not None and len(head[1])!=writer.row_size():
+                raise ValueError("Shard "+path+" has rows of "+str(len(head[1]))+" bytes but the merged output expects "+str(writer.row_size())+", merge with the -s the shards were run with")
+    for identifier, heavy, light in pair_records(read_fasta(input_fasta), window):
+        k=shard_of(identifier, len(readers))
+        if heads[k] is not None and heads[k][0]==identifier:
+            if format=="fasta":
+                writer.write(identifier, heads[k][1])
+            else:
+                writer.write_row(identifier, heads[k][1])
+            heads[k]=next(readers[k], None)
+    for k, head in enumerate(heads):
+        if head is not None:
+            print("Shard "+shard_paths[k]+" has pairs that are not in "+input_fasta+", starting with "+head[0])
+    return writer.count
+
+SCHEME_ALIASES = {"k":"kabat", "c":"chothia", "m":"martin"}
+
+class micro_batcher():
+    """
+    Merges pairs submitted by concurrent callers into batches. A batch is dispatched once it holds
+    `max_batch` pairs or `max_wait` seconds after its first pair arrived, whichever comes first.
+    A single dispatcher thread plans every batch through one chain planner per scheme, so chains
+    seen by earlier requests are not numbered again, and hands the new chains to a numbering
+    thread. A batch whose chains are all known is answered straight away instead of waiting for
+    the batches still being numbered.
+    """
+
+    def __init__(self, jobs=4, max_batch=64, max_wait=0.005, memo=200000):
+
+        self.jobs=jobs
+        self.max_batch=max_batch
+        self.max_wait=max_wait
+        self.memo=memo
+        self.planners={}
+        self.pending={}
+        self.lock=threading.Lock()
+        self.queue=deque()
+        self.queued=0
+        self.condition=threading.Condition()
+        self.executor=ThreadPoolExecutor(max_workers=jobs) if jobs>1 else None
+        # two batches share the jobs request threads, with -j 1 batches are numbered one at a time
+        self.numbering=ThreadPoolExecutor(max_workers=2 if jobs>1 else 1)
+        self.batches=0
+        self.pairs=0
+        self.requests=0
+        self.thread=threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "Micro batcher (%d requests, %d pairs in %d batches)" % (self.requests, self.pairs, self.batches)
+
+    def submit(self, pairs, scheme):
+        """
+        Number and space pairs together with whatever other callers submit at the same time
+        :param pairs: LIST, (heavy sequence, light sequence) tuples
+        :param scheme: STRING, numbering scheme
+        :return: LIST, (spaced heavy, spaced light) tuples, None for pairs that could not be numbered
+        """
+        request={"pairs":pairs, "scheme":scheme, "done":threading.Event(), "spaced":None, "error":None}
+        with self.condition:
+            self.queue.append(request)
+            self.queued+=len(pairs)
+            self.condition.notify()
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["spaced"]
+
+    def collect(self):
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            deadline=time.monotonic()+self.max_wait
+            while self.queued<self.max_batch:
+                remaining=deadline-time.monotonic()
+                if remaining<=0:
+                    break
+                self.condition.wait(remaining)
+            # a request is never split, one larger than max_batch makes a batch of its own
+            taken=[self.queue.popleft()]
+            size=len(taken[0]["pairs"])
+            while self.queue and size+len(self.queue[0]["pairs"])<=self.max_batch:
+                taken.append(self.queue.popleft())
+                size+=len(taken[-1]["pairs"])
+            self.queued-=size
+        return taken
+
+    def run(self):
+        while True:
+            taken=self.collect()
+            for scheme in set(request["scheme"] for request in taken):
+                group=[request for request in taken if request["scheme"]==scheme]
+                try:
+                    self.dispatch(group, scheme)
+                except Exception as e:
+                    for request in group:
+                        request["error"]=e
+                        request["done"].set()
+
+    def dispatch(self, group, scheme):
+        batch=[(n, heavy, light) for n, (heavy, light) in enumerate(pair for request in group for pair in request["pairs"])]
+        with self.lock:
+            planner=self.planners.get(scheme)
+            if planner is None:
+                planner=self.planners[scheme]=chain_planner(self.memo)
+                self.pending[scheme]=[]
+            todo=planner.plan(batch)
+            future=self.numbering.submit(space_chains, todo, scheme, self.jobs, self.executor) if todo else None
+            self.pending[scheme].append({"group":group, "batch":batch, "todo":todo, "future":future, "error":None})
+        if future is not None:
+            future.add_done_callback(lambda future: self.finish(scheme))
         else:
-            print("no scheme provided")
-            quit()
-        spaced_heavy_seq = ""
-        for x in range(len(Heavy_sorter)):
-            if Heavy_sorter[x] not in heavy_sequence_num_list:
-                spaced_heavy_seq += "X"
-            elif Heavy_sorter[x] in heavy_sequence_num_list:
-                spaced_heavy_seq += str(heavy_sequence_num.get(Heavy_sorter[x]))
-
-            #reordered_Heavy_dict = {x: Heavy_chain_ptm_counts[x] for x in Heavy_sorter}
-
-        spaced_light_seq = ""
-        for x in range(len(Light_sorter)):
-            if Light_sorter[x] not in light_sequence_num:
-                spaced_light_seq += "X"
-            elif Light_sorter[x] in light_sequence_num_list:
-                spaced_light_seq += str(light_sequence_num.get(Light_sorter[x]))
-        return(spaced_heavy_seq,spaced_light_seq)
-    except:
+            self.finish(scheme)
+
+    def finish(self, scheme):
+        """
+        Store the chains of every numbered batch of a scheme and answer each batch that no longer
+        needs a chain another batch is still numbering
+        :param scheme: STRING, numbering scheme
+        """
+        with self.lock:
+            planner=self.planners[scheme]
+            pending=self.pending[scheme]
+            for entry in pending:
+                if entry["future"] is not None and entry["future"].done():
+                    try:
+                        spaced=entry["future"].result()
+                    except Exception as e:
+                        # batches sharing these chains get them as failed rather than waiting forever
+                        entry["error"]=e
+                        spaced=[None]*len(entry["todo"])
+                    planner.store(entry["todo"], spaced)
+                    entry["future"]=None
+            ready=[entry for entry in pending if entry["future"] is None and
+                   not any(planner.memo[key] is _PENDING for n, heavy, light in entry["batch"] for key in (("H", heavy), ("L", light)))]
+            for entry in ready:
+                pending.remove(entry)
+                spaced=[pair for n, pair in planner.fan_out(entry["batch"])]
+                self.batches+=1
+                self.pairs+=len(entry["batch"])
+                self.requests+=len(entry["group"])
+                for request in entry["group"]:
+                    request["spaced"], spaced=spaced[:len(request["pairs"])], spaced[len(request["pairs"]):]
+                    request["error"]=entry["error"]
+                    request["done"].set()
+
+    def stats(self):
+        # called from handler threads while the dispatcher adds planners and counts batches
+        with self.lock:
+            return {"requests":self.requests, "pairs":self.pairs, "batches":self.batches, "mean_batch":self.pairs/float(self.batches) if self.batches else 0.0,
+                    "chains":sum(planner.chains for planner in self.planners.values()), "chains_numbered":sum(planner.numbered for planner in self.planners.values())}
+
+class spacing_handler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints of `--serve`:
+    POST /space {"heavy": ..., "light": ..., "scheme": ...} -> {"spaced": [heavy, light] or null}
+    POST /space_batch {"pairs": [[heavy, light], ...], "scheme": ...} -> {"spaced": [[heavy, light] or null, ...]}
+    GET /stats -> batching, deduplication, cache and (with --metrics) run metrics
+    The scheme may be left out to use the server's -s.
+    """
+
+    protocol_version="HTTP/1.1"
+    wbufsize=1<<16
+    disable_nagle_algorithm=True
+
+    def do_GET(self):
+        if self.path.rstrip("/")!="/stats":
+            self.reply(404, {"error":"unknown endpoint "+self.path})
+            return
+        stats=self.server.batcher.stats()
+        if cache is not None:
+            stats["cache_hits"], stats["cache_misses"]=cache.hits, cache.misses
+        if metrics.enabled:
+            stats["metrics"]=metrics.report()
+        self.reply(200, stats)
+
+    def do_POST(self):
+        try:
+            query=json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            scheme=SCHEME_ALIASES.get(query.get("scheme"), query.get("scheme")) or self.server.scheme
+            if scheme not in SCHEMES:
+                raise ValueError("unknown numbering scheme "+str(scheme))
+            if self.path.rstrip("/")=="/space":
+                pairs=[(query["heavy"], query["light"])]
+            elif self.path.rstrip("/")=="/space_batch":
+                pairs=[(heavy, light) for heavy, light in query["pairs"]]
+            else:
+                self.reply(404, {"error":"unknown endpoint "+self.path})
+                return
+            if not all(isinstance(seq, str) for pair in pairs for seq in pair):
+                raise ValueError("sequences must be strings")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.reply(400, {"error":"bad request: "+str(e)})
+            return
+        try:
+            spaced=self.server.batcher.submit(pairs, scheme)
+        except Exception as e:
+            self.reply(500, {"error":type(e).__name__+": "+str(e)})
+            return
+        self.reply(200, {"spaced":spaced[0] if self.path.rstrip("/")=="/space" else spaced})
+
+    def reply(self, status, body):
+        body=json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
         pass
 
+class unix_spacing_handler(spacing_handler):
+    # TCP_NODELAY does not exist for unix sockets
+    disable_nagle_algorithm=False
+
+class spacing_http_server(ThreadingHTTPServer):
+    daemon_threads=True
+    request_queue_size=128
+
+class unix_http_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads=True
+    request_queue_size=128
+
+def make_server(address, scheme, batcher):
+    """
+    Create the `--serve` server
+    :param address: STRING, host:port (or just a port) for TCP, or a path containing "/" for a unix socket
+    :param scheme: STRING, numbering scheme used when a request names none
+    :param batcher: micro_batcher, shared by all connections
+    :return: the server, call `serve_forever()` on it
+    """
+    if "/" in address:
+        # a socket left behind by a server that was killed would make bind fail
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server=unix_http_server(address, unix_spacing_handler)
+    else:
+        host, _, port=address.rpartition(":")
+        server=spacing_http_server((host or "127.0.0.1", int(port)), spacing_handler)
+    server.scheme=scheme
+    server.batcher=batcher
+    return server
+
 if __name__ == '__main__':
 
     my_parser = argparse.ArgumentParser(prog="abYspacer",
                                         usage='python %(prog)s [options]',
                                         description="Programme to generate numbered antibody sequences with 'X' to denote spaces in the numbering scheme")
-    my_parser.add_argument('-i','--input', type=str,help='the path to paired fasta file')
+    my_parser.add_argument('-i','--input', type=str,help='the path to paired fasta file (.fa or .fa.gz)')
     my_parser.add_argument('-o','--output', type=str,help='string of output fasta file')
-    my_parser.add_argument('-s','--scheme', type=str,help='k/kabat, c/chothia, m/martin')
+    my_parser.add_argument('-s','--scheme', type=str,help='k/kabat, c/chothia, m/martin, contact, imgt')
+    my_parser.add_argument('-f','--format', type=str, default='fasta', choices=['fasta', 'npy', 'npz', 'onehot'], help='fasta: spaced sequences, npy: uint8 matrix of residue codes, npz: the same compressed with identifiers, onehot: N x L x 21 one-hot array')
+    my_parser.add_argument('--batch-size', type=int, default=256, help='pairs numbered and written together (default: %(default)s)')
+    my_parser.add_argument('--pairing-window', type=int, default=10000, help='maximum number of chains kept waiting for their partner (default: %(default)s)')
+    my_parser.add_argument('--resume', action='store_true', help='continue an interrupted run from its checkpoint file (<output>.ckpt)')
+    my_parser.add_argument('--metrics', type=str, metavar='PATH', help='write per-stage timings, request counts, latency histogram and failures to this JSON file')
+    my_parser.add_argument('--progress', type=float, default=0, metavar='SECONDS', help='print throughput and ETA every SECONDS seconds (default: off)')
+    my_parser.add_argument('--profile', type=str, metavar='PATH', help='run under cProfile and dump the stats to PATH')
+    my_parser.add_argument('-w','--workers', type=int, default=1, help='worker processes numbering and spacing batches in parallel (default: %(default)s)')
+    my_parser.add_argument('--shard', type=str, metavar='I/N', help='only process the pairs whose identifier hashes to shard I of N (0-based)')
+    my_parser.add_argument('--merge', action='store_true', help='merge the shard outputs given as arguments, in shard order, into -o following the order of -i')
+    my_parser.add_argument('shards', nargs='*', help='shard outputs for --merge')
+    my_parser.add_argument('--serve', type=str, metavar='ADDRESS', help='run as a numbering server on host:port, or on a unix socket if ADDRESS contains "/", instead of processing -i')
+    my_parser.add_argument('--max-batch', type=int, default=64, help='--serve: most pairs numbered together in one micro-batch (default: %(default)s)')
+    my_parser.add_argument('--max-wait', type=float, default=5, metavar='MS', help='--serve: milliseconds a request may wait for others to join its micro-batch (default: %(default)s)')
+    my_parser.add_argument('--dedup-memo', type=int, default=200000, metavar='N', help='spaced chains remembered so repeated chains are numbered once, 0 to only deduplicate within a batch (default: %(default)s)')
+    my_parser.add_argument('-e','--engine', type=str, default='abnum', choices=['abnum', 'local'], help='abnum: number through the AbNum web service, local: number offline against bundled templates')
+    my_parser.add_argument('--check-agreement', action='store_true', help='compare the local engine with the recorded reference numberings and exit')
+    my_parser.add_argument('--abnum-url', type=str, default=ABNUM_URL, help='address of the AbNum CGI (default: %(default)s)')
+    my_parser.add_argument('-j','--jobs', type=int, default=4, help='number of simultaneous AbNum requests (default: %(default)s)')
+    my_parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each AbNum response (default: %(default)s)')
+    my_parser.add_argument('--retries', type=int, default=4, help='times a failed AbNum request is retried (default: %(default)s)')
+    my_parser.add_argument('--rate', type=float, default=10, help='maximum AbNum requests per second, 0 for no limit (default: %(default)s)')
+    my_parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH, metavar='PATH', help='numbering cache file (default: %(default)s)')
+    my_parser.add_argument('--no-cache', action='store_true', help='always ask AbNum, do not read or write the numbering cache')
+    my_parser.add_argument('--cache-size', type=int, default=1000000, help='maximum number of numberings kept in the cache')
 
-        #my_parser.print_help()
     args = my_parser.parse_args()
+    if args.check_agreement:
+        sys.exit(1 if check_agreement() else 0)
     input_fasta = args.input
-    if input_fasta is None:
+    if input_fasta is None and args.serve is None:
         print('No input was given. Exiting programme')
         sys.exit()
 
+    if args.shards and not args.merge:
+        print("Unexpected arguments "+" ".join(args.shards)+" (shard outputs are only taken with --merge)")
+        sys.exit(1)
 
     scheme = args.scheme
     if scheme is None or scheme == "kabat" or scheme == "k":
@@ -264,36 +1715,109 @@ if __name__ == '__main__':
         scheme = 'chothia'
     elif scheme == 'martin' or scheme == "m":
         scheme = 'martin'
+    elif scheme == 'contact' or scheme == 'imgt':
+        pass
     else:
         print("no suitable numbering scheme provided")
         quit()
+
+    if args.serve is not None:
+        if not args.no_cache:
+            cache = open_cache(args.cache, args.cache_size)
+        client = abnum_client(url=args.abnum_url, pool_size=args.jobs, timeout=args.timeout, retries=args.retries, rate=args.rate)
+        if args.engine == 'local':
+            backend = local_backend()
+        metrics = run_metrics(enabled=args.metrics is not None)
+        server = make_server(args.serve, scheme, micro_batcher(jobs=args.jobs, max_batch=args.max_batch, max_wait=args.max_wait/1000.0, memo=args.dedup_memo))
+        print("Serving %s numbering on %s (Ctrl-C to stop)" % (scheme, args.serve), flush=True)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        server.server_close()
+        if "/" in args.serve and os.path.exists(args.serve):
+            os.remove(args.serve)
+        if args.metrics is not None:
+            with open(args.metrics, "w") as f:
+                json.dump(metrics.report(), f, indent=1)
+        sys.exit()
     output_name = args.output
     if output_name is None:
-        output_name = str(input_fasta+"_"+str(scheme)+".faa")
+        output_name = str(input_fasta+"_"+str(scheme)+(".faa" if args.format == "fasta" else "."+args.format.replace("onehot", "onehot.npy")))
+    if args.format != 'fasta' and args.format != 'npy' and np is None:
+        print("numpy is required for --format "+args.format)
+        sys.exit(1)
+    if args.workers < 1:
+        print("--workers must be at least 1")
+        sys.exit(1)
+    shard = None
+    if args.shard is not None:
+        shard = tuple(int(part) for part in args.shard.split("/"))
+        if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            print("--shard must look like I/N with 0 <= I < N")
+            sys.exit(1)
+        if args.output is None:
+            output_name = output_name+".shard%dof%d" % shard
 
-    with open (input_fasta, "r") as f:
-        output = open(output_name,"w+")
-        for line in f:
-            if line[0] == ">":
-                if "_H|" in line or "_VH|" in line:
-                    Heavy_seq_identifier = line.strip()
-                    H_identifier = Heavy_seq_identifier.split("|")[1]
-                    Heavy_seq = f.readline().strip()
-                    Light_seq_identifier = f.readline().strip()
-                    L_identifier = Light_seq_identifier.split("|")[1]
-                    Light_seq = f.readline().strip()
-                    if H_identifier == L_identifier:
-                        spaced_sequences = get_spaced_sequence(Heavy_seq, Light_seq, scheme)
-                        if spaced_sequences is not None:
-                            output.write(str(">"+H_identifier+"_H|"+H_identifier+"\n"+spaced_sequences[0]+"\n>"+H_identifier+"_L|"+H_identifier+"\n"+spaced_sequences[1]+"\n"))
-                elif "_L|" in line or "_VH|" in line:
-                    Light_seq_identifier = line.strip()
-                    L_identifier = Light_seq_identifier.split("|")[1]
-                    Light_seq = f.readline().strip()
-                    Heavy_seq_identifier = line.strip()
-                    H_identifier = f.readline().split("|")[1]
-                    Heavy_seq = f.readline().strip()
-                    if H_identifier == L_identifier:
-                        get_spaced_sequence(Heavy_seq, Light_seq, scheme)
-                        if spaced_sequences is not None:
-                            output.write(str(">"+H_identifier+"_H|"+H_identifier+"\n"+spaced_sequences[0]+"\n>"+H_identifier+"_L|"+H_identifier+"\n"+spaced_sequences[1]+"\n"))
+    if args.merge:
+        if not args.shards:
+            print("--merge needs the shard outputs as arguments, in shard order")
+            sys.exit(1)
+        if args.format != 'fasta' and np is None:
+            print("numpy is required to merge --format "+args.format)
+            sys.exit(1)
+        output = fasta_writer(output_name) if args.format == 'fasta' else encoded_writer(output_name, scheme, args.format)
+        try:
+            written = merge_shards(input_fasta, args.shards, output, args.format, args.pairing_window)
+        except ValueError as e:
+            print(str(e))
+            output.close()
+            for path in (output_name, output_name+".ids.txt"):
+                if os.path.exists(path):
+                    os.remove(path)
+            sys.exit(1)
+        output.close()
+        print("%d pairs merged from %d shards into %s" % (written, len(args.shards), output_name))
+        sys.exit()
+
+    # with worker processes each worker opens the cache itself and reports its hits back
+    if not args.no_cache and args.workers <= 1:
+        cache = open_cache(args.cache, args.cache_size)
+    client = abnum_client(url=args.abnum_url, pool_size=args.jobs, timeout=args.timeout, retries=args.retries, rate=args.rate)
+    if args.engine == 'local':
+        backend = local_backend()
+
+    checkpoint = output_name+".ckpt"
+    state = load_checkpoint(checkpoint, input_fasta, scheme, shard) if args.resume else None
+    if state is not None:
+        print("Resuming after %d pairs" % state["pairs_done"])
+    resume = state["writer"] if state is not None else None
+    if args.format == 'fasta':
+        output = fasta_writer(output_name, resume=resume)
+    else:
+        output = encoded_writer(output_name, scheme, args.format, resume=resume)
+    metrics = run_metrics(enabled=args.metrics is not None)
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    settings = {"engine":args.engine, "cache":None if args.no_cache else args.cache, "cache_size":args.cache_size, "url":args.abnum_url, "jobs":args.jobs,
+                "timeout":args.timeout, "retries":args.retries, "rate":args.rate/args.workers, "metrics":metrics.enabled}
+    stats = run_pipeline(input_fasta, output, scheme, jobs=args.jobs, batch_size=args.batch_size, window=args.pairing_window, checkpoint=checkpoint,
+                         skip=state["pairs_done"] if state is not None else 0, progress=args.progress, workers=args.workers, settings=settings, shard=shard,
+                         planner=chain_planner(args.dedup_memo))
+    if args.profile is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    output.close()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print("%d pairs written, %d could not be numbered, %d chains unpaired" % (stats["written"], stats["failed"], stats["unpaired"]))
+    if stats["chains_numbered"]:
+        print("%d chains, %d numbered after deduplication (ratio %.2f)" % (stats["chains"], stats["chains_numbered"], stats["chains"]/float(stats["chains_numbered"])))
+
+    if stats["cache_hits"] or stats["cache_misses"]:
+        print("Numbering cache: %d hits, %d misses" % (stats["cache_hits"], stats["cache_misses"]))
+    if args.metrics is not None:
+        with open(args.metrics, "w") as f:
+            json.dump(metrics.report(), f, indent=1)
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+import argparse
+import http.client
+import json
+import socket
+import sys
+import threading
+
+class unix_connection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=60):
+
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path=socket_path
+
+    def connect(self):
+        self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # connect blocking: with a timeout set a full listen queue fails with EAGAIN instead of waiting
+        self.sock.connect(self.socket_path)
+        self.sock.settimeout(self.timeout)
+
+class spacing_client():
+    """
+    Client for a running `abYspacer.py --serve` server. Only the standard library is imported, so
+    it is cheap to load, and each thread keeps one connection open to the server.
+    """
+
+    def __init__(self, address, scheme=None, timeout=60):
+
+        if address.startswith("http://"):
+            address=address[len("http://"):].rstrip("/")
+        self.address=address
+        self.scheme=scheme
+        self.timeout=timeout
+        self._local=threading.local()
+
+    def __repr__(self):
+        return "abYspacer client for %s" % self.address
+
+    def _connect(self):
+        conn=getattr(self._local, "conn", None)
+        if conn is None:
+            if "/" in self.address:
+                conn=unix_connection(self.address, timeout=self.timeout)
+            else:
+                host, _, port=self.address.rpartition(":")
+                conn=http.client.HTTPConnection(host or "127.0.0.1", int(port), timeout=self.timeout)
+            self._local.conn=conn
+        return conn
+
+    def _call(self, method, path, query=None):
+        body=json.dumps(query).encode() if query is not None else None
+        headers={"Content-Type":"application/json"} if body is not None else {}
+        # a kept-alive connection the server has since closed fails once, the retry reconnects
+        for attempt in range(2):
+            conn=self._connect()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response=conn.getresponse()
+                reply=json.loads(response.read())
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                self._local.conn=None
+                if attempt:
+                    raise
+        if response.status!=200:
+            raise RuntimeError("abYspacer server answered %d: %s" % (response.status, reply.get("error")))
+        return reply
+
+    def get_spaced_sequence(self, Heavy_seq, Light_seq, scheme=None):
+        """
+        Number and space one pair on the server
+        :param Heavy_seq: STRING, heavy chain sequence
+        :param Light_seq: STRING, light chain sequence
+        :param scheme: STRING, numbering scheme, None for the client's or else the server's default
+        :return: TUPLE, (spaced heavy, spaced light), or None if the pair could not be numbered
+        """
+        spaced=self._call("POST", "/space", {"heavy":Heavy_seq, "light":Light_seq, "scheme":scheme or self.scheme})["spaced"]
+        return tuple(spaced) if spaced is not None else None
+
+    def get_spaced_sequences(self, pairs, scheme=None):
+        """
+        Number and space a batch of pairs on the server
+        :param pairs: LIST, (heavy sequence, light sequence) tuples
+        :param scheme: STRING, numbering scheme, None for the client's or else the server's default
+        :return: LIST, (spaced heavy, spaced light) tuples, None for pairs that could not be numbered
+        """
+        spaced=self._call("POST", "/space_batch", {"pairs":[list(pair) for pair in pairs], "scheme":scheme or self.scheme})["spaced"]
+        return [tuple(pair) if pair is not None else None for pair in spaced]
+
+    def stats(self):
+        return self._call("GET", "/stats")
+
+if __name__ == '__main__':
+
+    my_parser = argparse.ArgumentParser(prog="abYspacer_client",
+                                        usage='python %(prog)s ADDRESS [options] HEAVY LIGHT',
+                                        description="Space one heavy/light pair through a running abYspacer.py --serve server")
+    my_parser.add_argument('address', type=str, help='host:port or unix socket path the server listens on')
+    my_parser.add_argument('heavy', type=str, nargs='?', help='heavy chain sequence')
+    my_parser.add_argument('light', type=str, nargs='?', help='light chain sequence')
+    my_parser.add_argument('-s','--scheme', type=str, help='k/kabat, c/chothia, m/martin, contact, imgt (default: the server\'s)')
+    my_parser.add_argument('--stats', action='store_true', help='print the server statistics and exit')
+    args = my_parser.parse_intermixed_args()
+
+    client = spacing_client(args.address, args.scheme)
+    if args.stats:
+        print(json.dumps(client.stats(), indent=1))
+        sys.exit()
+    if args.heavy is None or args.light is None:
+        print("A heavy and a light chain sequence are needed")
+        sys.exit(1)
+    spaced = client.get_spaced_sequence(args.heavy, args.light)
+    if spaced is None:
+        print("The pair could not be numbered")
+        sys.exit(1)
+    print(spaced[0])
+    print(spaced[1])
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import abYspacer
+
+class mock_abnum_handler(BaseHTTPRequestHandler):
+    """
+    Answers `plain=1` AbNum queries. A sequence that was recorded gets its recorded response; any
+    other sequence gets the recorded numbering of the same length re-labelled with its own residues
+    (what the synthetic datasets contain), or failing that a numbering from the local engine.
+    """
+
+    protocol_version="HTTP/1.1"
+    # send headers and body in one segment, otherwise Nagle and delayed ACKs add ~40 ms per request
+    wbufsize=1<<16
+    disable_nagle_algorithm=True
+
+    def do_GET(self):
+        server=self.server
+        query=urlparse(self.path)
+        if query.path=="/_stats":
+            self.reply(200, json.dumps({"calls":server.calls, "errors":server.errors, "bytes":server.bytes_sent}))
+            return
+        params=parse_qs(query.query)
+        aaseq=params.get("aaseq", [""])[0]
+        scheme=params.get("scheme", ["-k"])[0]
+        with server.lock:
+            server.calls+=1
+        time.sleep(max(0.0, server.latency+random.uniform(-server.jitter, server.jitter)))
+        if random.random()<server.error_rate:
+            with server.lock:
+                server.errors+=1
+            self.reply(500, "Internal Server Error")
+            return
+        body=server.respond(aaseq, scheme)
+        with server.lock:
+            server.bytes_sent+=len(body)
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        body=body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class mock_abnum_server(ThreadingHTTPServer):
+    """
+    Local stand-in for the AbNum CGI with configurable latency, jitter (seconds, uniform +/-) and
+    fraction of requests answered with HTTP 500.
+    """
+
+    daemon_threads=True
+
+    def __init__(self, address, recorded=abYspacer.RECORDED_RESPONSES, latency=0.05, jitter=0.02, error_rate=0.0):
+
+        ThreadingHTTPServer.__init__(self, address, mock_abnum_handler)
+        self.latency=latency
+        self.jitter=jitter
+        self.error_rate=error_rate
+        self.calls=0
+        self.errors=0
+        self.bytes_sent=0
+        self.lock=threading.Lock()
+        self.engine=None
+        self.responses={}
+        self.by_length={}
+        with open(recorded) as f:
+            for record in json.load(f):
+                flag=abYspacer.SCHEME_FLAGS[record["scheme"]]
+                self.responses[flag, record["aaseq"]]=record["response"]
+                self.by_length[flag, len(record["aaseq"])]=record["response"].split()[0::2]
+
+    def respond(self, aaseq, flag):
+        """
+        Build the plain text response for one query
+        :param aaseq: STRING, amino acid sequence
+        :param flag: STRING, AbNum scheme flag such as -c
+        :return: STRING, one "label residue" line per numbered position
+        """
+        if (flag, aaseq) in self.responses:
+            return self.responses[flag, aaseq]
+        labels=self.by_length.get((flag, len(aaseq)))
+        if labels is not None:
+            return "".join(label+" "+residue+"\n" for label, residue in zip(labels, aaseq))
+        if self.engine is None:
+            self.engine=abYspacer.local_backend()
+        scheme=[name for name, value in abYspacer.SCHEME_FLAGS.items() if value==flag][0]
+        lst=self.engine.number(aaseq, scheme)
+        return "".join(lst[i]+" "+lst[i+1]+"\n" for i in range(0, len(lst), 2))
+
+def serve_mock(port, latency, jitter, error_rate, ready):
+    server=mock_abnum_server(("127.0.0.1", port), latency=latency, jitter=jitter, error_rate=error_rate)
+    ready.set()
+    server.serve_forever()
+
+def mock_stats(url):
+    return abYspacer.requests.get(url+"_stats", timeout=10).json()
+
+def write_dataset(path, pairs, mutation_rate=0.05, seed=0):
+    """
+    Write a synthetic paired fasta file by point-mutating the recorded heavy and light chains
+    :param path: STRING, output path
+    :param pairs: INT, number of pairs
+    :param mutation_rate: FLOAT, fraction of residues substituted in each chain
+    :param seed: INT, random seed
+    """
+    rng=random.Random(seed)
+    with open(abYspacer.RECORDED_RESPONSES) as f:
+        records=json.load(f)
+    heavy=[record["aaseq"] for record in records if record["response"].startswith("H")]
+    light=[record["aaseq"] for record in records if record["response"].startswith("L")]
+    alphabet=abYspacer.ENCODING_ALPHABET[1:]
+
+    def mutate(seq):
+        seq=list(seq)
+        for i in range(len(seq)):
+            if rng.random()<mutation_rate:
+                seq[i]=rng.choice(alphabet)
+        return "".join(seq)
+
+    with open(path, "w", buffering=1<<20) as f:
+        for i in range(pairs):
+            identifier="syn"+str(i)
+            f.write(">"+identifier+"_VH|"+identifier+"\n"+mutate(rng.choice(heavy))+"\n>"+identifier+"_VL|"+identifier+"\n"+mutate(rng.choice(light))+"\n")
+
+def percentile(values, fraction):
+    values=sorted(values)
+    if not values:
+        return None
+    return values[min(len(values)-1, int(fraction*len(values)))]
+
+def bench_cli(dataset, pairs, url, scheme, jobs, extra_args=()):
+    """
+    Time the command line programme over a dataset
+    :return: DICT, throughput, peak RSS of the child process and HTTP calls per pair
+    """
+    output=dataset+".out"
+    before=mock_stats(url)
+    command=[sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "abYspacer.py"), "-i", dataset, "-o", output, "-s", scheme,
+             "--abnum-url", url, "--jobs", str(jobs), "--rate", "0", "--no-cache"]+list(extra_args)
+    start=time.perf_counter()
+    process=subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    pid, status, usage=os.wait4(process.pid, 0)
+    seconds=time.perf_counter()-start
+    after=mock_stats(url)
+    written=0
+    if os.path.exists(output):
+        with open(output) as f:
+            written=sum(1 for line in f if line.startswith(">"))//2
+        os.remove(output)
+    return {"driver":"cli", "pairs":pairs, "jobs":jobs, "args":list(extra_args), "exit_status":os.waitstatus_to_exitcode(status),
+            "seconds":seconds, "pairs_per_sec":pairs/seconds, "written":written,
+            "peak_rss_mb":usage.ru_maxrss/1024.0, "http_calls_per_pair":(after["calls"]-before["calls"])/float(pairs),
+            "http_errors":after["errors"]-before["errors"]}
+
+def bench_api(dataset, url, scheme, limit):
+    """
+    Time get_spaced_sequence pair by pair in this process
+    :return: DICT, throughput, per-pair latency percentiles, peak RSS and HTTP calls per pair
+    """
+    abYspacer.client=abYspacer.abnum_client(url=url, rate=None)
+    abYspacer.cache=None
+    abYspacer.backend=abYspacer.abnum_backend()
+    before=mock_stats(url)
+    latencies=[]
+    failed=0
+    start=time.perf_counter()
+    for identifier, heavy, light in abYspacer.pair_records(abYspacer.read_fasta(dataset)):
+        if len(latencies)>=limit:
+            break
+        pair_start=time.perf_counter()
+        if abYspacer.get_spaced_sequence(heavy, light, scheme) is None:
+            failed+=1
+        latencies.append(time.perf_counter()-pair_start)
+    seconds=time.perf_counter()-start
+    after=mock_stats(url)
+    return {"driver":"get_spaced_sequence", "pairs":len(latencies), "seconds":seconds, "pairs_per_sec":len(latencies)/seconds,
+            "p50_ms":percentile(latencies, 0.5)*1000, "p99_ms":percentile(latencies, 0.99)*1000, "failed":failed,
+            "peak_rss_mb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+            "http_calls_per_pair":(after["calls"]-before["calls"])/float(len(latencies))}
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+
+    my_parser = argparse.ArgumentParser(prog="benchmark",
+                                        usage='python %(prog)s [options]',
+                                        description="Benchmark abYspacer against a local mock AbNum server")
+    my_parser.add_argument('--sizes', type=str, default='1000', help='comma separated dataset sizes in pairs, e.g. 1000,100000,1000000 (default: %(default)s)')
+    my_parser.add_argument('-s','--scheme', type=str, default='chothia', help='numbering scheme (default: %(default)s)')
+    my_parser.add_argument('-j','--jobs', type=int, default=8, help='--jobs passed to the command line programme (default: %(default)s)')
+    my_parser.add_argument('--cli-args', type=str, default='', help='extra arguments for the command line programme, e.g. "--batch-size 512"')
+    my_parser.add_argument('--api-pairs', type=int, default=200, help='pairs timed one by one through get_spaced_sequence for each size (default: %(default)s)')
+    my_parser.add_argument('--latency', type=float, default=0.05, help='mock server response time in seconds (default: %(default)s)')
+    my_parser.add_argument('--jitter', type=float, default=0.02, help='uniform +/- jitter on the response time in seconds (default: %(default)s)')
+    my_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500 (default: %(default)s)')
+    my_parser.add_argument('--port', type=int, default=8765, help='port for the mock server (default: %(default)s)')
+    my_parser.add_argument('--workdir', type=str, default=None, help='where datasets are written (default: a temporary directory)')
+    my_parser.add_argument('-o','--output', type=str, default='benchmark.json', help='JSON results file (default: %(default)s)')
+    args = my_parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_mock, args=(args.port, args.latency, args.jitter, args.error_rate, ready), daemon=True)
+    server.start()
+    ready.wait()
+    url = "http://127.0.0.1:%d/" % args.port
+    workdir = args.workdir or tempfile.mkdtemp(prefix="abyspacer-bench-")
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        dataset = os.path.join(workdir, "pairs_%d.fa" % size)
+        if not os.path.exists(dataset):
+            write_dataset(dataset, size)
+        result = bench_cli(dataset, size, url, args.scheme, args.jobs, args.cli_args.split())
+        print("cli %d pairs: %.1f pairs/sec, %.1f MB peak RSS, %.2f HTTP calls/pair" % (size, result["pairs_per_sec"], result["peak_rss_mb"], result["http_calls_per_pair"]))
+        results.append(result)
+        result = bench_api(dataset, url, args.scheme, args.api_pairs)
+        print("get_spaced_sequence %d pairs: %.1f pairs/sec, p50 %.1f ms, p99 %.1f ms" % (result["pairs"], result["pairs_per_sec"], result["p50_ms"], result["p99_ms"]))
+        results.append(result)
+
+    server.terminate()
+    with open(args.output, "w") as f:
+        json.dump({"version":version(), "python":platform.python_version(), "platform":platform.platform(), "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "settings":vars(args), "results":results}, f, indent=1)
+    print("Results written to "+args.output)